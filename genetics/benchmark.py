@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+benchmark.py
+
+micro benchmarks for the hot paths of the genetic algorithm
+
+Every function of pool.py that is called in the evolution loop is timed on
+its own, on synthetic images of several sizes and with several numbers of
+polygons. Nothing is displayed, so this also runs on the cluster.
+
+    python benchmark.py [--sizes 64x48 160x120] [--polies 10 50]
+                        [--time 1.0] [--output benchmark.json]
+                        [--compare old_benchmark.json]
+
+For every benchmark, image size and number of polygons the result contains
+the operations per second and two rough hints on the memory, not the
+allocations of the operations (python 2 has no tracemalloc):
+live_objects: python objects per operation that were still alive after
+the run, i.e. caches that grew or leaks (numpy arrays are not counted),
+peak_rss_growth_bytes: growth of the peak memory of the process during
+the run, 0 if it stayed below an earlier peak. The results are stored as
+json together with the commit and versions they were measured with, with
+--compare the ratio to the ops/sec of an earlier run is printed.
+"""
+
+import os, sys, time, json, argparse
+import shutil
+import subprocess
+import tempfile
+import gc
+import resource
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+import cairo
+from poly_burst.genetics import pool
+
+conf_file = os.path.join(os.path.dirname(__file__), 'conf.json')
+
+
+def make_image(fname, width, height, seed=0):
+    """random polygons over color gradients, written to a png file"""
+    rng = np.random.RandomState(seed)
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+    context = cairo.Context(surface)
+    ar = pool.surface_array(surface)
+    yy, xx = np.mgrid[0:height, 0:width]
+    ar[:,:,0] = 255 * xx / width
+    ar[:,:,1] = 255 * yy / height
+    ar[:,:,2] = 128
+    surface.mark_dirty()
+    for i in range(20):
+        points = zip(rng.randint(0, width, 4), rng.randint(0, height, 4))
+        pool.draw_poly(context, {'points': points,
+                                 'color': tuple(rng.random_sample(4))})
+    surface.write_to_png(fname)
+
+
+def memory_usage():
+    """number of python objects tracked by the garbage collector and the
+        peak memory (bytes) of the process so far
+    """
+    gc.collect()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        # kilobytes on linux, bytes on mac os
+        peak *= 1024
+    return len(gc.get_objects()), peak
+
+
+def measure(operation, min_time, setup=None):
+    """call operation until min_time seconds were spent in it
+
+        setup (not timed) is called before every operation, returns the
+        dict with the results of the benchmark
+    """
+    n, elapsed = 0, 0.0
+    start_objects, start_peak = memory_usage()
+    while elapsed < min_time:
+        if setup:
+            setup()
+        start = time.time()
+        operation()
+        elapsed += time.time() - start
+        n += 1
+    objects, peak = memory_usage()
+    return {"ops": n, "time": elapsed, "ops_per_sec": n / elapsed,
+            "live_objects": (objects - start_objects) / float(n),
+            "peak_rss_growth_bytes": peak - start_peak}
+
+
+def bench_drawing(image_file, conf, n_polies, min_time):
+    """time the functions of pool.py for a drawing with n_polies polygons"""
+    conf = dict(conf, max_polies=max(conf['max_polies'], n_polies + 1),
+                seed=0, image_seed=None)
+    drawing = pool.Drawing(image_file, conf)
+    polies = [pool.create_random_poly(drawing.w, drawing.h,
+                                      conf['min_poly_points'],
+                                      conf['locality'],
+                                      conf['alpha_mutations'],
+                                      drawing.rng)
+              for i in range(n_polies)]
+    drawing.set_polies(polies)
+    drawing.evaluate()
+    results = {}
+
+    results['create_random_poly'] = measure(
+        lambda: pool.create_random_poly(drawing.w, drawing.h,
+                                        conf['min_poly_points'],
+                                        conf['locality'],
+                                        conf['alpha_mutations'],
+                                        drawing.rng), min_time)
+    results['draw_poly'] = measure(
+        lambda: pool.draw_poly(drawing.context, polies[0]), min_time)
+    results['to_numpy'] = measure(lambda: pool.to_numpy(drawing.surface),
+                                  min_time)
+
+    # mutate, evaluate and revert only work in this order, the steps that
+    # are not timed are done in the setup of a benchmark
+    def undo():
+        if drawing._journal is not None:
+            drawing.revert_last_mutation()
+
+    def evaluate_undo():
+        if drawing._journal is not None:
+            drawing.evaluate()
+            drawing.revert_last_mutation()
+
+    def mutate_undone():
+        undo()
+        drawing.mutate()
+
+    def mutate_evaluated():
+        drawing.mutate()
+        drawing.evaluate()
+
+    def generation():
+        drawing.mutate()
+        drawing.evaluate()
+        drawing.revert_last_mutation()
+
+    results['mutate'] = measure(drawing.mutate, min_time, setup=evaluate_undo)
+    results['evaluate'] = measure(drawing.evaluate, min_time,
+                                  setup=mutate_undone)
+    undo()
+    results['revert_last_mutation'] = measure(drawing.revert_last_mutation,
+                                              min_time, setup=mutate_evaluated)
+    results['generation'] = measure(generation, min_time)
+    results['get_sorted_polies'] = measure(drawing.get_sorted_polies, min_time)
+    return results
+
+
+def git_commit():
+    """hash of the checked out commit (None if not in a git repository)"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except Exception:
+        return None
+
+
+def run(sizes, n_polies, conf, min_time):
+    """run all benchmarks, returns the results as a json serializable dict"""
+    tmp_dir = tempfile.mkdtemp()
+    results = {"commit": git_commit(),
+               "python": sys.version.split()[0],
+               "numpy": np.__version__,
+               "min_time": min_time,
+               "conf": conf,
+               "benchmarks": {}}
+    try:
+        for width, height in sizes:
+            image_file = os.path.join(tmp_dir, '%dx%d.png' % (width, height))
+            make_image(image_file, width, height)
+            for n in n_polies:
+                key = '%dx%d_%d' % (width, height, n)
+                results['benchmarks'][key] = bench_drawing(image_file, conf,
+                                                           n, min_time)
+                for name, result in sorted(results['benchmarks'][key].items()):
+                    print '%-16s %-22s %12.1f ops/sec' % (key, name,
+                                                         result['ops_per_sec'])
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def compare(results, old_results):
+    """print the speedup of every benchmark relative to an older run"""
+    print 'speedup relative to commit %s' % old_results.get('commit')
+    for key, benchmarks in sorted(results['benchmarks'].items()):
+        for name, result in sorted(benchmarks.items()):
+            old = old_results['benchmarks'].get(key, {}).get(name)
+            if old:
+                print '%-16s %-22s %8.2fx' % (
+                    key, name, result['ops_per_sec'] / old['ops_per_sec'])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='benchmark of pool.py')
+    parser.add_argument('--sizes', nargs='+', default=['64x48', '160x120', '320x240'],
+                        help='image sizes as WIDTHxHEIGHT')
+    parser.add_argument('--polies', nargs='+', type=int, default=[10, 50],
+                        help='numbers of polygons in the drawing')
+    parser.add_argument('--time', type=float, default=1.0,
+                        help='seconds every benchmark runs at least')
+    parser.add_argument('--conf', default=conf_file,
+                        help='config file with the mutation rates, etc.')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='json file to write the results to')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    conf = json.load(open(args.conf))
+    sizes = [tuple(int(v) for v in size.split('x')) for size in args.sizes]
+    results = run(sizes, args.polies, conf, args.time)
+    json.dump(results, open(args.output, 'w'), indent=2)
+    if args.compare:
+        compare(results, json.load(open(args.compare)))
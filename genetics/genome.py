@@ -0,0 +1,162 @@
+"""genome.py
+
+    compact representation of the polygons of a drawing
+
+    The drawing itself works on a list of polygon dicts ({"points": [(x, y),
+    ...], "color": (r, g, b, a)}), the format that is also written to
+    polies.json. A Genome stores the same information in preallocated numpy
+    arrays, every polygon owns a slot of max_poly_points rows in the vertex
+    array. This makes copies and pickles small and allows to work on all
+    polygons at once with numpy.
+"""
+
+import numpy as np
+
+
+def _values_dtype(values, default):
+    """dtype that stores the values without loss (int stays int)"""
+    if len(values) == 0:
+        return default
+    return np.asarray(values).dtype
+
+
+class Genome(object):
+    """array backed storage of up to max_polies polygons
+
+        points[offsets[i]:offsets[i] + counts[i]] are the vertices of
+        polygon i and colors[i] its RGBA color. The optional error and
+        position values of polies.json are kept in errors and positions,
+        missing values are marked by the has_error and has_position masks.
+    """
+
+    def __init__(self, max_polies, max_poly_points,
+                 point_dtype=np.int64, error_dtype=np.float64):
+        super(Genome, self).__init__()
+        self.max_polies = max_polies
+        self.max_poly_points = max_poly_points
+        self.n = 0
+        self.offsets = np.arange(max_polies) * max_poly_points
+        self.counts = np.zeros(max_polies, np.int32)
+        self.points = np.zeros((max_polies * max_poly_points, 2), point_dtype)
+        self.colors = np.zeros((max_polies, 4))
+        self.errors = np.zeros(max_polies, error_dtype)
+        self.has_error = np.zeros(max_polies, bool)
+        self.positions = np.zeros(max_polies, np.int64)
+        self.has_position = np.zeros(max_polies, bool)
+
+    @classmethod
+    def from_polies(cls, polies, max_polies=None, max_poly_points=None):
+        """create a genome from a list of polygon dicts"""
+        all_points = [point for poly in polies for point in poly['points']]
+        all_errors = [poly['error'] for poly in polies if 'error' in poly]
+        max_polies = max(max_polies or 0, len(polies), 1)
+        max_poly_points = max([max_poly_points or 0, 1] +
+                              [len(poly['points']) for poly in polies])
+        genome = cls(max_polies, max_poly_points,
+                     point_dtype=_values_dtype(all_points, np.int64),
+                     error_dtype=_values_dtype(all_errors, np.float64))
+        for i, poly in enumerate(polies):
+            genome.insert_poly(i, poly)
+        return genome
+
+    def to_polies(self):
+        """convert the genome back to the list of polygon dicts"""
+        polies = []
+        for i in range(self.n):
+            poly = {"points": [tuple(point) for point in
+                               self.poly_points(i).tolist()],
+                    "color": tuple(self.colors[i].tolist())}
+            if self.has_error[i]:
+                poly['error'] = self.errors[i].item()
+            if self.has_position[i]:
+                poly['position'] = self.positions[i].item()
+            polies.append(poly)
+        return polies
+
+    def __len__(self):
+        return self.n
+
+    def poly_points(self, i):
+        """view on the vertices of polygon i"""
+        return self.points[self.offsets[i]:self.offsets[i] + self.counts[i]]
+
+    def insert_poly(self, idx, poly):
+        """insert a polygon dict at position idx of the drawing order"""
+        if self.n == self.max_polies:
+            raise Exception('genome is full (max_polies: %d)' % self.max_polies)
+        if len(poly['points']) > self.max_poly_points:
+            raise Exception('too many points (max_poly_points: %d)'
+                            % self.max_poly_points)
+        self._shift(idx, self.n, idx + 1)
+        self.n += 1
+        self.counts[idx] = len(poly['points'])
+        self.poly_points(idx)[:] = poly['points']
+        self.colors[idx] = poly['color']
+        self.has_error[idx] = 'error' in poly
+        self.errors[idx] = poly.get('error', 0)
+        self.has_position[idx] = 'position' in poly
+        self.positions[idx] = poly.get('position', 0)
+
+    def remove_poly(self, idx):
+        """remove the polygon at position idx of the drawing order"""
+        self._shift(idx + 1, self.n, idx)
+        self.n -= 1
+
+    def swap_polies(self, i, j):
+        """exchange the position of two polygons in the drawing order"""
+        for ar in self._poly_arrays():
+            ar[[i, j]] = ar[[j, i]]
+        slot_i = self.points[self.offsets[i]:self.offsets[i] + self.max_poly_points]
+        slot_j = self.points[self.offsets[j]:self.offsets[j] + self.max_poly_points]
+        slot_i[:], slot_j[:] = slot_j.copy(), slot_i.copy()
+
+    def copy(self):
+        """a copy of the genome (copies only the arrays)"""
+        genome = Genome.__new__(Genome)
+        genome.__dict__ = self.__dict__.copy()
+        for key in ['counts', 'points', 'colors', 'errors', 'has_error',
+                    'positions', 'has_position']:
+            setattr(genome, key, getattr(self, key).copy())
+        return genome
+
+    def _poly_arrays(self):
+        return [self.counts, self.colors, self.errors, self.has_error,
+                self.positions, self.has_position]
+
+    def _shift(self, start, stop, dest):
+        """move the slots of the polygons start:stop to start at dest"""
+        n = stop - start
+        if n <= 0:
+            return
+        for ar in self._poly_arrays():
+            ar[dest:dest + n] = ar[start:stop].copy()
+        slot = self.max_poly_points
+        self.points[dest * slot:(dest + n) * slot] = \
+            self.points[start * slot:stop * slot].copy()
+
+    def __getstate__(self):
+        """only pickle the used part of the arrays"""
+        n = self.n
+        return {'max_polies': self.max_polies,
+                'max_poly_points': self.max_poly_points,
+                'counts': self.counts[:n].copy(),
+                'points': np.concatenate([self.points[:0]] +
+                                         [self.poly_points(i) for i in range(n)]),
+                'colors': self.colors[:n].copy(),
+                'errors': self.errors[:n].copy(),
+                'has_error': self.has_error[:n].copy(),
+                'positions': self.positions[:n].copy(),
+                'has_position': self.has_position[:n].copy()}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_polies'], state['max_poly_points'],
+                      point_dtype=state['points'].dtype,
+                      error_dtype=state['errors'].dtype)
+        n = self.n = len(state['counts'])
+        for key in ['counts', 'colors', 'errors', 'has_error',
+                    'positions', 'has_position']:
+            getattr(self, key)[:n] = state[key]
+        start = 0
+        for i in range(n):
+            self.poly_points(i)[:] = state['points'][start:start + self.counts[i]]
+            start += self.counts[i]
@@ -17,10 +17,8 @@ import logging
 import pickle
 import matplotlib
 matplotlib.use("Agg")
-import numpy as np
-import pylab as plt
-import cairo
 import pool
+import telemetry
 import json
 import signal
 
@@ -63,7 +61,7 @@ for i in range(conf["n_generations"]):
     start = time.time()
 
     drawing.mutate()
-    tmp_error = drawing.evaluate()
+    tmp_error = drawing.evaluate(error)
 
     if tmp_error < error:
         error = tmp_error
@@ -73,16 +71,15 @@ for i in range(conf["n_generations"]):
 
             # write plots and files
             logging.info("average time: %f" % (c_time/drawing.generations))
-            plt.figure()
-            plt.subplot(2, 1, 1)
-            plt.plot(drawing.errors)
-            plt.subplot(2, 1, 2)
-            plt.plot(np.diff(drawing.selections))
-            plt.savefig(path.join(outfolder, 'plot.png'))
+            telemetry.plot_evolution(drawing.errors, drawing.selections,
+                                     path.join(outfolder, 'plot.png'))
             image_name = 'output%d.png' % len(drawing.selections)
             drawing.surface.write_to_png(path.join(outfolder, image_name))
-            # update the config dict, maybe it has changed
-            drawing.conf = json.load(open('conf.json'))
+            # update the config dict, maybe it has changed, the seed of
+            # the drawing is not in the file and must stay
+            new_conf = json.load(open('conf.json'))
+            new_conf['image_seed'] = drawing.conf['image_seed']
+            drawing.conf = new_conf
     else:
         drawing.revert_last_mutation()
 
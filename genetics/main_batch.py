@@ -12,13 +12,28 @@ evolution of a *polygon decomposition* of an image is taken from [1].
 To run the script
 -----------------
 
-    python main_batch.py path/to/conf.json
+    python main_batch.py path/to/conf.json [--workers N]
+    python main_batch.py --resume path/to/outfolder/timestamp [--workers N]
+
+With --workers N the images are processed in N parallel processes (an
+image that fails does not stop the others, the results and errors of all
+images are collected in results.json).
+
+With --resume the run in the given output folder is continued with the
+config file stored there. Images that are finished (polies.json written)
+are skipped, all others continue from their last checkpoint.
 
 Set the required parameters (where to find the images, etc) in the config file
 
     infolder: where to find the images
     outfolder: where to store the output
     n_generations: how many iterations should be done
+    seed: seed of the random numbers of the run. Every image gets its own
+          seed (image_seed) derived from it and the name of the image, so
+          a run with the same seed gives exactly the same results, no
+          matter how many workers are used. A random seed is drawn (and
+          written to the conf.json of the run) if it is not set. To repeat
+          a single image, set image_seed to the value in its conf.json.
     locality: this is a bit more complicated. At one point a realized that
               the polygons that the image is composed of in the result do not
               represent *parts* of the image. They do not represent local
@@ -44,20 +59,131 @@ Set the required parameters (where to find the images, etc) in the config file
     move_poly_rate: probability that a polygon is moved in the order in which
                     the polygons are drawn
 
+    adaptive_rates: adapt the rates above (and move_point, color_std) during
+                    the evolution. Every adapt_window times a mutation
+                    operator was used, its rate is increased if it improved
+                    the drawing more often than mutations in general and
+                    decreased otherwise. move_point and color_std grow if
+                    more than a fifth of the point (color) moves improved
+                    the drawing and shrink otherwise (1/5th success rule).
+                    Only the serial evolution adapts its rates (not lambda
+                    or islands), the final values are written to the
+                    conf.json of the image.
+    adapt_window: number of uses of an operator between two adaptations
+
+    random_blocks: draw the random numbers of the mutations in blocks of
+                   many numbers instead of one by one. Same distribution of
+                   mutations but much less overhead per generation (the
+                   mutations differ from those without it for the same seed)
+    render_cache: keep the rendered layers of the drawing in memory and only
+                  redraw the polygons above the lowest mutated one. Gives
+                  exactly the same result, costs one image per polygon of
+                  memory
+    incremental_error: only recompute the error for the rectangle of the
+                       image that was changed by the last mutation
+    init: how the polygons of a new drawing are placed, random (default),
+          kmeans (one polygon per cluster of similar pixels, in their mean
+          color) or gradient (small polygons on the edges of the image),
+          see seeding.py. min_polies polygons are created.
+    error_heatmap: keep the error of the drawing in tiles of heatmap_tile
+                   pixels and target the mutations at the tiles with high
+                   error: new polygons and points are placed around a tile
+                   drawn by its error and points in such tiles are moved
+                   more often (needs random_blocks and incremental_error)
+    heatmap_tile: size of the tiles of error_heatmap in pixels
+    heatmap_bias: fraction of the new polygons and points that are targeted,
+                  the others are placed uniformly as without the heatmap
+    color_refit_interval: every this many generations the colors of all
+                          polygons are set to the mean color of the image
+                          where they are visible (kept if not worse, only
+                          for opaque polygons, not used if not set or with
+                          islands)
+    color_refit_final: refit the colors once more at the end of the
+                       evolution of an image
+    early_abort: stop computing the error of a mutation as soon as it is
+                 sure to be worse than the current drawing, the mutation is
+                 rejected without summing up the rest of the image
+    abort_rows: number of image rows summed up between two checks of
+                early_abort
+    raster_samples: samples per pixel side for the numpy rendering that is
+                    used to score many candidates at once (see raster.py)
+
+    lambda: number of mutations of the current drawing that are evaluated
+            in every step, the best of them is selected if it is not worse
+            than the current drawing ((1+lambda) evolution). With 1 (the
+            default) a single mutation is tried at a time.
+    lambda_workers: number of processes that evaluate the lambda mutations,
+                    all cores are used if it is not set
+
+    pyramid_levels: number of levels of the image pyramid. With more than 1
+                    level the evolution starts on the image downsampled by
+                    2**(pyramid_levels - 1) and continues on the next finer
+                    level after pyramid_generations generations or when the
+                    error did not improve for pyramid_plateau generations.
+                    The final result is always at the original resolution.
+    pyramid_generations: maximal number of generations on a coarse level
+    pyramid_plateau: generations without improvement after which the
+                     evolution moves on to the next finer level
+
+    islands: number of independent lineages of the drawing that evolve in
+             parallel processes (island model, not used if not set). After
+             every migration_interval generations the genome of the best
+             island replaces the genomes of the island_migrants worst
+             islands, the best island is the final result. The islands
+             always evolve on the original image resolution and do not
+             write checkpoints. n_generations counts the generations of
+             every island, not their sum.
+    migration_interval: generations every island evolves between migrations
+    island_migrants: number of worst islands replaced by the best one
+    island_workers: number of processes for the islands (default all cores)
+
+    ref_cache: directory in which the reference images are cached as uint8
+               arrays that all processes map into memory, instead of every
+               process loading its own copy (default: the temp directory)
+
+    telemetry_size: number of values of the error and selection history that
+                    are kept, older values are thinned out when it is full
+
+    stop_window: stop the evolution of an image early when the error
+                 improved by less than stop_epsilon (relative to the error)
+                 within the last stop_window generations (not used if not
+                 set). Only checked on the original image resolution.
+    stop_epsilon: relative improvement below which the error counts as flat
+    target_error: stop as soon as the error is not larger than this
+    time_budget: stop after this many seconds of evolution for an image
+                 (including the time before a --resume)
+
+    profile: record the time spent in the phases of the evolution (mutate,
+             render, error, revert, snapshot, checkpoint, plot, ...) and
+             write their histograms and percentiles to profile.json
+    profile_sampling: interval (seconds of cpu time) of a sampling profiler
+                      that counts the functions on the stack, also written
+                      to profile.json (not used if not set)
+
+    checkpoint_every: write a checkpoint every n selections (not at all if
+                      it is not set) from which the evolution can continue
+                      after a crash (see --resume)
+
 
 Output of the script
 --------------------
 
 For each run of the script a new folder is created, named by current time.
 It contains a README.txt (with exactly *this* text) and a folder for each
-processed image, named by the name of the image.
+processed image, named by the name of the image. When run with --workers
+it also contains results.json with the final error, number of generations
+and time (or the error message) of every image. With profile set it also
+contains profile.json, the time of the phases summed over all images.
 Those image folders contain:
 
 * conf.json
     * a copy of the config file the script was run with to create the output
+    * with adaptive_rates the rates reached at the end of the evolution
+    * image_seed: the seed of the random numbers of this image
 * plot.png
     * top: is a plot of the error function over selections
     * bottom: number mutations that took place between two selectios
+    * for long runs the history is downsampled (see telemetry.py)
 * polies.json
     * the polygon decomposition of the image
     * polygons are represented by
@@ -67,8 +193,12 @@ Those image folders contain:
                  is removed from the polygon decomposition. It can be used
                  to rank the polygons according to ther *importance*
 * drawing.pckl
-    * a pickle of the drawing object
-    * this also contains the original image, the error values, etc
+    * a pickle of the drawing object, the polygons are stored as a compact
+      genetics.genome.Genome and converted back to dicts when loaded
+    * this also contains the error values, etc. The reference image is only
+      referenced by path and hash (see refstore.py), it is loaded from the
+      cache (ref_cache) or the image.png next to the pickle when unpickled
+      with refstore.load_pickle('drawing.pckl'), so the folder can be moved
     * is just stored in case we need it for later analyses
 * decomp
     * images of the single polygons that the composition consists of
@@ -78,64 +208,223 @@ Those image folders contain:
     * images from intermediate steps of the evolution
 * final.png
     * the final result of the evolution
+* info.json
+    * size of the image and the reason the evolution stopped (stop_reason:
+      n_generations, plateau, target_error or time_budget)
+* profile.json
+    * only with profile set, for every phase of the evolution the number of
+      calls, total, mean, max and percentiles (p50, p90, p99) of the time
+      in seconds and the histogram of the times (bins: profiling.BIN_EDGES)
+    * with profile_sampling the functions with the most samples
+* checkpoint.pckl
+    * only while the image is processed, the state of the evolution
+      (polygons, random state, counters and errors) to continue from
 
 [1]: rogeralsing.com/2008/12/07/genetic-programming-evolution-of-mona-lisa/
 
 Created by Stephan Gabler on 2011-10-31.
 """
 
-import os, sys, glob, time, logging, shutil
+import os, sys, glob, time, logging, shutil, traceback
+import argparse
+import multiprocessing
 from os import path
-import pickle, json
+import pickle, json, copy
 import matplotlib
 matplotlib.use("Agg")
-import numpy as np
-import pylab as plt
-import cairo
 from poly_burst.genetics import pool
+from poly_burst.genetics import parallel
+from poly_burst.genetics import telemetry
+from poly_burst.genetics import profiling
 import poly_burst.polyTessellator as tessellator
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s %(levelname)s %(message)s',
                     datefmt='%m-%d %H:%M')
 
-try:
-    conf = json.load(open(sys.argv[1]))
-except Exception, e:
-    print "don't forget the config file"
-    sys.exit()
 
-c_time = 0
-timestamp = time.strftime("%d%m%y_%H%M%S", time.localtime())
-outfolder = path.join(conf['outfolder'], timestamp)
-os.mkdir(outfolder)
-json.dump(conf,
-          open(path.join(outfolder, 'conf.json'), 'w'),
-          indent=2)
+class StopCriteria(object):
+    """decide when the evolution of an image can stop before n_generations
+
+        see stop_window, stop_epsilon, target_error and time_budget in the
+        description of the config file
+    """
+
+    def __init__(self, conf):
+        super(StopCriteria, self).__init__()
+        self.window = conf.get('stop_window')
+        self.epsilon = conf.get('stop_epsilon', 0)
+        self.target = conf.get('target_error')
+        self.budget = conf.get('time_budget')
+        # generation and error at the start of the current window
+        self.start = None
+
+    def reset(self, generations, error):
+        """start a new window (e.g. when the error changed its scale)"""
+        self.start = (generations, error)
+
+    def check(self, drawing, error, c_time):
+        """the reason to stop the evolution now, None to continue"""
+        if self.budget is not None and c_time >= self.budget:
+            return 'time_budget'
+        if drawing.level > 0:
+            return None
+        if self.target is not None and error <= self.target:
+            return 'target_error'
+        if self.window:
+            if self.start is None:
+                self.reset(drawing.generations, error)
+            generations, start_error = self.start
+            if drawing.generations - generations >= self.window:
+                if start_error - error <= self.epsilon * start_error:
+                    return 'plateau'
+                self.reset(drawing.generations, error)
+        return None
+
+
+def write_checkpoint(fname, drawing, error, c_time, stop=None, pyramid=None):
+    """write the state of the evolution to fname (atomically)
+
+        pyramid is the tuple (level_start, last_improvement) of the
+        generations the pyramid schedule counts from
+    """
+    checkpoint = drawing.get_checkpoint()
+    checkpoint.update({"error": error, "c_time": c_time,
+                       "stop_start": stop and stop.start,
+                       "pyramid": pyramid})
+    tmp_name = fname + '.tmp'
+    with open(tmp_name, 'wb') as f:
+        pickle.dump(checkpoint, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_name, fname)
+
+
+def refit_colors(drawing, error):
+    """try the closed form colors of the drawing, returns the new error"""
+    if not drawing.refit_colors():
+        return error
+    tmp_error = drawing.evaluate(error)
+    if tmp_error <= error:
+        return tmp_error
+    drawing.revert_last_mutation()
+    return error
+
+
+def evolve_islands(drawing, image_file, conf, evol_path, n_workers=None,
+                   stop=None):
+    """evolve several independent lineages of the drawing (island model)
+
+        after every migration interval the drawing takes over the genome of
+        the best island, the StopCriteria stop are checked after every
+        migration. Returns the error and the reason to stop.
+    """
+    if drawing.level > 0:
+        drawing.set_level(0)
+    islands = parallel.IslandPool(image_file, conf, n_workers)
+    population = [drawing.polies] + [drawing.create_polies()
+                                     for i in range(islands.n_islands - 1)]
+    error = sys.maxint
+    reason, c_time = 'n_generations', 0
+    while drawing.generations < conf["n_generations"]:
+        start = time.time()
+        with profiling.phase(drawing.profile, 'islands'):
+            results = islands.evolve(population, rng=drawing.rng)
+        # generations of every lineage, more islands use more cores for
+        # the same n_generations
+        drawing.generations += islands.interval
+        error, polies = results[0]
+        drawing.accept_offspring(copy.deepcopy(polies), error)
+        drawing.print_state()
+        logging.info("island errors: %s" % [int(e) for e, p in results])
+        with profiling.phase(drawing.profile, 'snapshot'):
+            drawing.as_array()
+            image_name = 'output%d.png' % len(drawing.selections)
+            drawing.surface.write_to_png(path.join(evol_path, image_name))
+        population = [island for e, island in results]
+        c_time += time.time() - start
+        stopped = stop and stop.check(drawing, error, c_time)
+        if stopped:
+            reason = stopped
+            break
+    islands.close()
+    return error, reason
+
 
+def process_image(image_file, conf, outfolder, offspring_workers=None):
+    """evolve the polygon decomposition of an image and write the results
 
-for image_file in glob.glob(path.join(conf['infolder'], '*.png')):
+        the evolution continues from the checkpoint of an earlier run if
+        there is one in the output folder of the image
 
+        returns a dict with some information on the finished evolution
+    """
+    c_time = 0
     tmp_out = path.join(outfolder, path.basename(image_file)[:-4])
-    os.mkdir(tmp_out)
     decomp_path = path.join(tmp_out, 'decomp')
-    os.mkdir(decomp_path)
     evol_path = path.join(tmp_out, 'evol')
-    os.mkdir(evol_path)
+    for folder in [tmp_out, decomp_path, evol_path]:
+        if not path.exists(folder):
+            os.mkdir(folder)
+    checkpoint_file = path.join(tmp_out, 'checkpoint.pckl')
+    checkpoint_every = conf.get('checkpoint_every')
 
     logging.info('working on: %s' % image_file)
 
     # create a random drawing
     drawing = pool.Drawing(image_file, conf)
     error = sys.maxint
-
-    for i in range(conf["n_generations"]):
+    stop = StopCriteria(conf)
+    pyramid = None
+    if path.exists(checkpoint_file):
+        logging.info('continue from: %s' % checkpoint_file)
+        checkpoint = pickle.load(open(checkpoint_file, 'rb'))
+        drawing.set_checkpoint(checkpoint)
+        error, c_time = checkpoint['error'], checkpoint['c_time']
+        stop.start = checkpoint.get('stop_start')
+        pyramid = checkpoint.get('pyramid')
+    stop_reason = None
+    profile = drawing.profile
+    sampler = None
+    if conf.get('profile_sampling'):
+        sampler = profiling.SamplingProfiler(conf['profile_sampling'])
+        sampler.start()
+    offspring = None
+    if conf.get('lambda', 1) > 1:
+        offspring = parallel.OffspringPool(image_file, conf, offspring_workers)
+    if conf.get('islands', 1) > 1:
         start = time.time()
-
-        drawing.mutate()
-        tmp_error = drawing.evaluate()
+        error, stop_reason = evolve_islands(drawing, image_file, conf,
+                                            evol_path, offspring_workers, stop)
+        c_time += time.time() - start
+    level_start = last_improvement = drawing.generations
+    if pyramid:
+        level_start, last_improvement = pyramid
+    level_generations = conf.get('pyramid_generations') or sys.maxint
+    plateau = conf.get('pyramid_plateau') or sys.maxint
+    refit_interval = conf.get('color_refit_interval')
+    if refit_interval:
+        next_refit = (drawing.generations // refit_interval + 1) * refit_interval
+
+    while not stop_reason and drawing.generations < conf["n_generations"]:
+        start = time.time()
+        checkpoint_due = False
+
+        if offspring:
+            with profiling.phase(profile, 'offspring'):
+                tmp_error, polies = offspring.best_offspring(drawing.polies,
+                                                             drawing.level,
+                                                             drawing.rng)
+            drawing.generations += offspring.n_offspring
+            if tmp_error <= error:
+                drawing.accept_offspring(polies, tmp_error)
+        else:
+            drawing.mutate()
+            tmp_error = drawing.evaluate(error)
 
         if tmp_error <= error:
+            if tmp_error < error:
+                last_improvement = drawing.generations
             error = tmp_error
 
             if len(drawing.selections) % 500 == 0:
@@ -145,34 +434,83 @@ for image_file in glob.glob(path.join(conf['infolder'], '*.png')):
                 # write plots and files
                 logging.info("avg time: %f" % (c_time/drawing.generations))
                 image_name = 'output%d.png' % len(drawing.selections)
-                drawing.surface.write_to_png(path.join(evol_path, image_name))
-        else:
+                with profiling.phase(profile, 'snapshot'):
+                    if offspring:
+                        # the offspring was rendered in a worker process
+                        drawing.as_array()
+                    drawing.surface.write_to_png(path.join(evol_path,
+                                                           image_name))
+
+            checkpoint_due = (checkpoint_every and
+                              len(drawing.selections) % checkpoint_every == 0)
+        elif not offspring:
             drawing.revert_last_mutation()
 
+        if refit_interval and drawing.generations >= next_refit:
+            with profiling.phase(profile, 'color_refit'):
+                error = refit_colors(drawing, error)
+            next_refit = (drawing.generations // refit_interval + 1) * refit_interval
+
+        # continue on the next finer level of the image pyramid
+        if drawing.level > 0 and (
+                drawing.generations - level_start >= level_generations or
+                drawing.generations - last_improvement >= plateau):
+            drawing.set_level(drawing.level - 1)
+            error = drawing.evaluate()
+            level_start = last_improvement = drawing.generations
+            stop.reset(drawing.generations, error)
+            logging.info('pyramid level %d, error: %d' % (drawing.level, error))
+
         c_time += time.time() - start
+        if profile:
+            profile.add('generation', time.time() - start)
+        stop_reason = stop.check(drawing, error, c_time)
+
+        # at the end of the generation, so a resumed run continues with
+        # exactly the state of the next generation
+        if checkpoint_due:
+            with profiling.phase(profile, 'checkpoint'):
+                write_checkpoint(checkpoint_file, drawing, error, c_time,
+                                 stop, (level_start, last_improvement))
+
+    stop_reason = stop_reason or 'n_generations'
+    logging.info('stopped after %d generations: %s'
+                 % (drawing.generations, stop_reason))
+
+    if offspring:
+        offspring.close()
+    if drawing.level > 0:
+        drawing.set_level(0)
+    if conf.get('color_refit_final'):
+        error = refit_colors(drawing, drawing.evaluate())
 
     # write the final output for an image
     logging.info('writing output to: %s' % tmp_out)
-    plt.figure()
-    plt.subplot(2, 1, 1)
-    plt.plot(drawing.errors)
-    plt.subplot(2, 1, 2)
-    plt.plot(np.diff(drawing.selections))
-    plt.savefig(path.join(tmp_out, 'plot.png'))
+    with profiling.phase(profile, 'plot'):
+        telemetry.plot_evolution(drawing.errors, drawing.selections,
+                                 path.join(tmp_out, 'plot.png'))
     shutil.copyfile(image_file, path.join(tmp_out, 'image.png'))
+    # the pickle does not depend on the infolder, the (temporary) cache or
+    # where the outfolder is moved to
+    drawing.set_image_file('image.png')
     pickle.dump(drawing,
                 open(path.join(tmp_out, 'drawing.pckl'), 'w'))
     drawing.evaluate()
     drawing.surface.write_to_png(path.join(tmp_out, 'final.png'))
 
+    json.dump(drawing.conf,
+              open(path.join(tmp_out, 'conf.json'), 'w'),
+              indent=2)
+
     logging.info('write info file to: %s' % decomp_path)
-    info = {"size": (drawing.w, drawing.h)}
+    info = {"size": (drawing.w, drawing.h), "stop_reason": stop_reason}
     json.dump(info,
               open(path.join(tmp_out, 'info.json'), 'w'),
               indent=2)
 
     logging.info('writing single polygons to: %s' % decomp_path)
-    sorted_polies = drawing.get_sorted_polies(write_to_disk=decomp_path)
+    with profiling.phase(profile, 'sorted_polies'):
+        sorted_polies = drawing.get_sorted_polies(write_to_disk=decomp_path)
     for poly in sorted_polies:
 
         newPoints = [];
@@ -187,5 +525,112 @@ for image_file in glob.glob(path.join(conf['infolder'], '*.png')):
     json.dump(sorted_polies,
               open(path.join(tmp_out, 'polies.json'), 'w'),
               indent=2)
-    open(path.join(outfolder, 'README.txt'), 'w').write(__doc__)
-tessellator.transDecomp(outfolder)
+    if sampler:
+        sampler.stop()
+    if profile or sampler:
+        json.dump({"phases": profile and profile.to_dict(),
+                   "sampling": sampler and sampler.to_dict()},
+                  open(path.join(tmp_out, 'profile.json'), 'w'),
+                  indent=2)
+    if path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    return {"error": int(error),
+            "generations": drawing.generations,
+            "selections": len(drawing.selections),
+            "time": c_time,
+            "stop_reason": stop_reason}
+
+
+def run_image(args):
+    """process_image in a worker process, errors are sent to the parent
+
+        returns the tuple (image_file, result, traceback)
+    """
+    image_file, conf, outfolder = args
+    try:
+        # daemon processes can not start their own worker processes
+        result = process_image(image_file, conf, outfolder,
+                               offspring_workers=1)
+        return image_file, result, None
+    except Exception:
+        return image_file, None, traceback.format_exc()
+
+
+def process_images(image_files, conf, outfolder, n_workers):
+    """process every image in its own worker process
+
+        a failing image does not stop the others, the results of all
+        images (or the traceback of the failed ones) are collected in
+        results.json in the outfolder
+    """
+    workers = multiprocessing.Pool(n_workers)
+    tasks = [(image_file, conf, outfolder) for image_file in image_files]
+    results_file = path.join(outfolder, 'results.json')
+    results = {}
+    if path.exists(results_file):
+        results = json.load(open(results_file))
+    for i, (image_file, result, error) in enumerate(
+            workers.imap_unordered(run_image, tasks)):
+        if error:
+            logging.error('failed on %s:\n%s' % (image_file, error))
+        else:
+            logging.info('finished %s: %s' % (image_file, result))
+        logging.info('%d of %d images done' % (i + 1, len(tasks)))
+        results[path.basename(image_file)] = result or {"failed": error}
+    workers.close()
+    workers.join()
+    json.dump(results,
+              open(results_file, 'w'),
+              indent=2)
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='polygon decomposition')
+    parser.add_argument('config', nargs='?', help='path to the config file')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of images processed in parallel')
+    parser.add_argument('--resume', metavar='OUTFOLDER',
+                        help='continue the run in this output folder')
+    args = parser.parse_args()
+    if args.resume:
+        args.config = path.join(args.resume, 'conf.json')
+    try:
+        conf = json.load(open(args.config))
+    except Exception, e:
+        print "don't forget the config file"
+        sys.exit()
+
+    if args.resume:
+        outfolder = args.resume
+    else:
+        if conf.get('seed') is None:
+            conf['seed'] = pool.new_seed()
+        timestamp = time.strftime("%d%m%y_%H%M%S", time.localtime())
+        outfolder = path.join(conf['outfolder'], timestamp)
+        os.mkdir(outfolder)
+        json.dump(conf,
+                  open(path.join(outfolder, 'conf.json'), 'w'),
+                  indent=2)
+        open(path.join(outfolder, 'README.txt'), 'w').write(__doc__)
+
+    image_files = glob.glob(path.join(conf['infolder'], '*.png'))
+    finished = [f for f in image_files if path.exists(
+        path.join(outfolder, path.basename(f)[:-4], 'polies.json'))]
+    for image_file in finished:
+        logging.info('already finished: %s' % image_file)
+    image_files = [f for f in image_files if f not in finished]
+    if args.workers > 1:
+        process_images(image_files, conf, outfolder, args.workers)
+    else:
+        for image_file in image_files:
+            process_image(image_file, conf, outfolder)
+    if conf.get('profile'):
+        profiles = [json.load(open(fname))['phases'] for fname in
+                    glob.glob(path.join(outfolder, '*', 'profile.json'))]
+        json.dump({"images": len(profiles),
+                   "phases": profiling.summary(profiles)},
+                  open(path.join(outfolder, 'profile.json'), 'w'),
+                  indent=2)
+    tessellator.transDecomp(outfolder)
@@ -0,0 +1,181 @@
+"""parallel.py
+
+    evaluate mutations of a drawing in several processes
+
+    Every worker process loads its own Drawing of the image once (in
+    init_worker) and afterwards only receives the polygons of the parent
+    drawing and the random seeds for the mutations it has to try. As the
+    mutations only depend on the parent and the seed, a worker just has to
+    send back the polygons of its best offspring. The seeds are drawn from
+    the random state of the parent drawing, so the result does not depend
+    on the number of workers or on which worker runs which task.
+
+    The same workers can also evolve whole lineages of a drawing for many
+    generations (IslandPool), the best lineages then migrate to the islands
+    with the worst ones.
+"""
+
+import copy
+import multiprocessing
+import numpy as np
+import pool
+
+# the drawing of the worker process, created by init_worker
+_drawing = None
+
+
+def init_worker(image_file, conf):
+    """load the drawing in which the offspring of this worker are evaluated
+
+        the rates of the workers stay fixed, an offspring must only depend
+        on the parent and its seed
+    """
+    global _drawing
+    _drawing = pool.Drawing(image_file, dict(conf, adaptive_rates=False))
+
+
+def _mutate(seed):
+    """mutate the worker drawing with the random state given by seed"""
+    _drawing.reseed(seed)
+    _drawing.mutate()
+
+
+def best_of_chunk(args):
+    """try the mutations given by the seeds and return the best offspring
+
+        seeds is a list of (index, seed), returns the tuple (error, index,
+        polies) of the best offspring, of equal ones the first
+    """
+    polies, seeds, level = args
+    if _drawing.level != level:
+        # without processes the polygons of the last task are the ones of
+        # the parent, which is already on the new level
+        _drawing.set_polies([])
+        _drawing.set_level(level)
+    _drawing.set_polies(polies)
+    _drawing.evaluate()
+    best_error, best_index, best_seed = None, None, None
+    for index, seed in seeds:
+        _mutate(seed)
+        error = _drawing.evaluate(best_error)
+        _drawing.revert_last_mutation()
+        if best_error is None or error < best_error:
+            best_error, best_index, best_seed = error, index, seed
+    _mutate(best_seed)
+    best_polies = copy.deepcopy(_drawing.polies)
+    _drawing.revert_last_mutation()
+    return best_error, best_index, best_polies
+
+
+def evolve_island(args):
+    """evolve the polygons for n_generations in the worker drawing
+
+        returns the tuple (error, polies) of the evolved drawing
+    """
+    polies, seed, level, n_generations = args
+    _drawing.reseed(seed)
+    if _drawing.level != level:
+        _drawing.set_level(level)
+    # the polygons of the task stay as they are (map without processes)
+    _drawing.set_polies(copy.deepcopy(polies))
+    error = _drawing.evaluate()
+    for i in range(n_generations):
+        _drawing.mutate()
+        tmp_error = _drawing.evaluate(error)
+        if tmp_error <= error:
+            error = tmp_error
+        else:
+            _drawing.revert_last_mutation()
+    return error, copy.deepcopy(_drawing.polies)
+
+
+class WorkerPool(object):
+    """processes with a Drawing of the image to evaluate mutations
+
+        with only one worker everything is done in the current process,
+        which is also the way to use it from within a daemon process
+    """
+
+    def __init__(self, image_file, conf, n_workers):
+        super(WorkerPool, self).__init__()
+        self.n_workers = max(1, n_workers)
+        if self.n_workers > 1:
+            self.pool = multiprocessing.Pool(self.n_workers, init_worker,
+                                             (image_file, conf))
+            self.map = self.pool.map
+        else:
+            self.pool = None
+            self.map = map
+            init_worker(image_file, conf)
+
+    def close(self):
+        """stop the worker processes"""
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+
+
+class OffspringPool(WorkerPool):
+    """create the lambda offspring of a (1+lambda) evolution in parallel
+
+        conf['lambda'] mutations of the parent are evaluated on
+        conf['lambda_workers'] processes (all cores if not set)
+    """
+
+    def __init__(self, image_file, conf, n_workers=None):
+        self.n_offspring = conf['lambda']
+        if n_workers is None:
+            n_workers = conf.get('lambda_workers') or multiprocessing.cpu_count()
+        super(OffspringPool, self).__init__(image_file, conf,
+                                            min(n_workers, self.n_offspring))
+
+    def best_offspring(self, polies, level=0, rng=np.random):
+        """error and polygons of the best of lambda mutations of polies
+
+            level is the pyramid level of the drawing (see Drawing.set_level),
+            the seeds of the mutations are drawn from rng. Of offspring with
+            the same error the one of the first seed wins, whichever worker
+            evaluated it.
+        """
+        seeds = list(enumerate(rng.randint(0, 2**31 - 1, self.n_offspring)))
+        chunks = [(polies, seeds[i::self.n_workers], level)
+                  for i in range(self.n_workers)]
+        results = self.map(best_of_chunk, chunks)
+        error, index, polies = min(results, key=lambda result: result[:2])
+        return error, polies
+
+
+class IslandPool(WorkerPool):
+    """evolve conf['islands'] lineages of a drawing in parallel
+
+        every island evolves on its own for conf['migration_interval']
+        generations, afterwards the genome of the best island replaces the
+        genomes of the conf['island_migrants'] worst islands. The islands
+        are distributed over conf['island_workers'] processes (all cores if
+        not set).
+    """
+
+    def __init__(self, image_file, conf, n_workers=None):
+        self.n_islands = conf['islands']
+        self.interval = conf.get('migration_interval', 1000)
+        self.n_migrants = min(conf.get('island_migrants', 1), self.n_islands - 1)
+        if n_workers is None:
+            n_workers = conf.get('island_workers') or multiprocessing.cpu_count()
+        super(IslandPool, self).__init__(image_file, conf,
+                                         min(n_workers, self.n_islands))
+
+    def evolve(self, population, level=0, rng=np.random):
+        """evolve the polygons of all islands and let the best migrate
+
+            population is a list with the polygons of every island, returns
+            the list of (error, polies) of the islands, best island first.
+            The seeds of the islands are drawn from rng.
+        """
+        seeds = rng.randint(0, 2**31 - 1, len(population))
+        tasks = [(polies, seed, level, self.interval)
+                 for polies, seed in zip(population, seeds)]
+        islands = self.map(evolve_island, tasks)
+        islands.sort(key=lambda island: island[0])
+        for i in range(1, self.n_migrants + 1):
+            islands[-i] = copy.deepcopy(islands[0])
+        return islands
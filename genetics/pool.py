@@ -1,19 +1,45 @@
 import os
-from random import choice
-from numpy.random import random, normal, uniform, randint
+import math
+import zlib
 import numpy as np
 import cairo
 import logging
 import json
-import copy
-import pylab as plt
+from genome import Genome
+import raster
+from telemetry import Series
+import profiling
+import refstore
+import seeding
+from spatial import GridIndex
+
+# the operators of mutate that can adapt their rate (and step size) online
+ADAPTIVE_RATES = ['poly_rate', 'move_poly_rate', 'point_rate',
+                  'move_point_rate', 'color_rate']
+ADAPTIVE_STEPS = {'move_point_rate': 'move_point', 'color_rate': 'color_std'}
+ADAPT_FACTOR = 1.2
+ADAPT_SUCCESS = 0.2
+RATE_BOUNDS = (0.005, 0.5)
+STEP_BOUNDS = {'move_point': (1, 200), 'color_std': (0.001, 0.25)}
+
+# number of random numbers RandomBlocks draws at once
+BLOCK_SIZE = 4096
+
+# error returned by evaluate for a mutation that was rejected early, i.e. it
+# is worse than every error it can be compared to (the bound)
+REJECTED = float('inf')
+
+# the methods timed with conf['profile'] and their phase names
+PROFILED = [('mutate', 'mutate'), ('render', '_render'),
+            ('error', '_compute_error'), ('revert', 'revert_last_mutation')]
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s %(levelname)s %(message)s',
                     datefmt='%m-%d %H:%M')
 
 
-def create_random_poly(width, height, n_points, local, alpha_mutations):
+def create_random_poly(width, height, n_points, local, alpha_mutations,
+                       rng=np.random):
     """create a random polygon in the given range
 
         width, height -- size of the image in which the polygons reside
@@ -22,7 +48,9 @@ def create_random_poly(width, height, n_points, local, alpha_mutations):
                  to False, the points for the polygons are drawn from the
                  whole range. If local is between 0 and 1 the points are
                  drawn from the surrounding of an initial random point.
+        rng -- the numpy RandomState to draw from
     """
+    random, randint = rng.random_sample, rng.randint
     if not local:
         points = zip(randint(0, width, n_points),
                      randint(0, height, n_points))
@@ -34,16 +62,98 @@ def create_random_poly(width, height, n_points, local, alpha_mutations):
             y = min(height, max(0, points[0][1] + randint(local*height)))
             points.append((x,y))
     if alpha_mutations:
-        color = (random(), random(), random(), uniform(0.3, 0.6))
+        color = (random(), random(), random(), rng.uniform(0.3, 0.6))
     else:
         color = (random(), random(), random(), 1)
     return {"points": points, "color": color}
 
+def new_seed():
+    """a random seed from the entropy of the operating system"""
+    return int(np.frombuffer(os.urandom(4), np.uint32)[0])
+
+def image_seed(seed, image_file):
+    """seed for the drawing of an image, derived from the seed of the run
+
+        every image of a run gets its own random numbers, independent of the
+        order (or process) in which the images are processed
+    """
+    name = os.path.basename(image_file).encode('ascii', 'ignore')
+    return (seed + zlib.crc32(name)) & 0xffffffff
+
 def to_numpy(surf):
     """docstring for to_numpy"""
     res = np.frombuffer(surf.get_data(), np.uint8)
     return res.reshape((surf.get_height(), surf.get_width(), 4))[:,:,0:3]
 
+def surface_array(surf):
+    """the complete (BGRX) pixel buffer of a surface as writable numpy view
+
+        remember to call surf.flush() before reading and surf.mark_dirty()
+        after writing to the array
+    """
+    res = np.frombuffer(surf.get_data(), np.uint8)
+    return res.reshape((surf.get_height(), surf.get_width(), 4))
+
+def ssd(ref, image, scratch):
+    """sum of square differences between ref and image
+
+        ref and image are uint8 arrays of the same shape (image usually a
+        view on the cairo buffer), scratch is an int32 array of this shape
+        that is overwritten, so no temporary array is created
+    """
+    np.subtract(ref, image, out=scratch, dtype=np.int32)
+    np.multiply(scratch, scratch, out=scratch)
+    return scratch.sum(dtype=np.int64)
+
+def bounded_ssd(ref, image, scratch, bound, rows):
+    """ssd summed up in blocks of rows, stops once the sum exceeds bound
+
+        returns the tuple (sum, complete), if complete is False the sum
+        only covers the first rows and is already larger than bound
+    """
+    total = 0
+    for y in range(0, ref.shape[0], rows):
+        total += ssd(ref[y:y+rows], image[y:y+rows], scratch[y:y+rows])
+        if total > bound:
+            return total, False
+    return total, True
+
+def downsample(image, level):
+    """the image downsampled by 2**level by averaging blocks of pixels"""
+    if level == 0:
+        return image
+    factor = 2 ** level
+    h = image.shape[0] // factor
+    w = image.shape[1] // factor
+    blocks = image[:h*factor, :w*factor].reshape(h, factor, w, factor, 3)
+    return np.rint(blocks.mean(axis=3).mean(axis=1)).astype(np.uint8)
+
+def poly_bbox(poly, width, height):
+    """the pixel rectangle (x0, y0, x1, y1) that drawing poly might change
+
+        one pixel is added to every side to be on the safe side with
+        antialiasing and the rectangle is clipped to the image size
+    """
+    xs, ys = zip(*poly['points'])
+    return (max(0, int(math.floor(min(xs))) - 1),
+            max(0, int(math.floor(min(ys))) - 1),
+            min(width, int(math.ceil(max(xs))) + 1),
+            min(height, int(math.ceil(max(ys))) + 1))
+
+def union_rect(rect1, rect2):
+    """smallest rectangle containing both rectangles (None is empty)"""
+    if rect1 is None:
+        return rect2
+    if rect2 is None:
+        return rect1
+    return (min(rect1[0], rect2[0]), min(rect1[1], rect2[1]),
+            max(rect1[2], rect2[2]), max(rect1[3], rect2[3]))
+
+def rects_overlap(rect1, rect2):
+    """whether the two rectangles have pixels in common"""
+    return (rect1[0] < rect2[2] and rect2[0] < rect1[2] and
+            rect1[1] < rect2[3] and rect2[1] < rect1[3])
+
 def draw_poly(context, poly, on_black=False):
     """docstring for draw_poly"""
     if on_black:
@@ -57,6 +167,60 @@ def draw_poly(context, poly, on_black=False):
     context.fill()
 
 
+class RandomBlocks(object):
+    """uniform and normal random numbers drawn from rng in blocks
+
+        one call to numpy for many numbers is much faster than one call per
+        number, uniform(n) and normal(n) return the next n numbers as list
+        of python floats
+    """
+
+    def __init__(self, rng, size=BLOCK_SIZE):
+        super(RandomBlocks, self).__init__()
+        self.rng = rng
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        """forget the numbers drawn so far (e.g. after seeding rng)"""
+        self._uniform, self._uniform_pos = [], 0
+        self._normal, self._normal_pos = [], 0
+
+    def uniform(self, n):
+        """n numbers from the uniform distribution on [0, 1)"""
+        pos = self._uniform_pos
+        if pos + n > len(self._uniform):
+            self._uniform = self.rng.random_sample(max(self.size, n)).tolist()
+            pos = 0
+        self._uniform_pos = pos + n
+        return self._uniform[pos:pos + n]
+
+    def normal(self, n):
+        """n numbers from the standard normal distribution"""
+        pos = self._normal_pos
+        if pos + n > len(self._normal):
+            self._normal = self.rng.standard_normal(max(self.size, n)).tolist()
+            pos = 0
+        self._normal_pos = pos + n
+        return self._normal[pos:pos + n]
+
+    def get_state(self):
+        """the numbers that were drawn but not used yet"""
+        return (np.array(self._uniform[self._uniform_pos:]),
+                np.array(self._normal[self._normal_pos:]))
+
+    def set_state(self, state):
+        self._uniform, self._normal = state[0].tolist(), state[1].tolist()
+        self._uniform_pos = self._normal_pos = 0
+
+    def __getstate__(self):
+        """only pickle the numbers that were not used yet"""
+        return {'rng': self.rng, 'size': self.size, 'state': self.get_state()}
+
+    def __setstate__(self, state):
+        self.rng, self.size = state['rng'], state['size']
+        self.set_state(state['state'])
+
 
 class Drawing(object):
     """a drawing of random polygons
@@ -66,45 +230,401 @@ class Drawing(object):
 
     def __init__(self, image_file, conf):
         super(Drawing, self).__init__()
-        # load the reference image from disk and convert it to the proper range
-        tmp = plt.imread(image_file.encode('ascii','ignore'))
-        self.ref_image = (tmp * 255).astype(np.int32)[:,:,::-1]
+        # the reference image as uint8 BGR array, mapped from the cache that
+        # all processes share (see refstore.py)
+        native_ref, self._ref = refstore.load(image_file, conf.get('ref_cache'))
+        self.ref_image = native_ref.view(np.ndarray)
         self.w = np.shape(self.ref_image)[1]
         self.h = np.shape(self.ref_image)[0]
+        # the drawing can also evolve on a downsampled version of the
+        # image, self.level is the number of times it was halved
+        self._native_ref = self.ref_image
+        self.level = 0
+        self.scale = 1.0
         self.polies = []
-        self.old_polies = []
-        self.conf = conf
+        self._journal = None
+        # own copy, the rates change with conf['adaptive_rates']
+        self.conf = dict(conf)
+        if conf.get('error_heatmap') and not (conf.get('random_blocks') and
+                                              conf.get('incremental_error')):
+            raise Exception('error_heatmap needs random_blocks and '
+                            'incremental_error')
         self.generations = 0
-        self.selections = []
-        self.errors = []
+        self._fired = []
+        self._parent_error = None
+        self._adapt_stats = {}
+        # all random numbers of the drawing are drawn from self.rng, the
+        # seed is recorded in the conf (see image_seed)
+        if conf.get('image_seed') is None:
+            seed = conf.get('seed')
+            if seed is None:
+                seed = new_seed()
+            self.conf['image_seed'] = image_seed(seed, image_file)
+        self.rng = np.random.RandomState(self.conf['image_seed'])
+        self._random = RandomBlocks(self.rng)
+        # history of the evolution, bounded in size (see telemetry.py)
+        capacity = conf.get('telemetry_size', 4096)
+        self.selections = Series(capacity)
+        self.errors = Series(capacity)
+
+        self._invalidate_cache()
+        self._allocate_buffers()
+        # time spent in the phases of the evolution (see profiling.py)
+        self.profile = None
+        if conf.get('profile'):
+            self.profile = profiling.Profile()
+            self._wrap_profiled()
 
         # inititialize cairo drawing
         self.surface = cairo.ImageSurface(cairo.FORMAT_RGB24, self.w, self.h)
         self.context = cairo.Context(self.surface)
-        for i in range(conf['min_polies']):
-            self.polies.append(create_random_poly(self.w,
-                                                  self.h,
-                                                  conf['min_poly_points'],
-                                                  conf['locality'],
-                                                  conf['alpha_mutations']))
+        if conf.get('pyramid_levels', 1) > 1:
+            self.set_level(conf['pyramid_levels'] - 1)
+        self.polies = self.create_polies()
+
+    def create_polies(self):
+        """the polygons a new drawing starts with (see seeding.py)"""
+        init = self.conf.get('init') or 'random'
+        if init != 'random':
+            return seeding.create_polies(init, self.ref_image,
+                                         self.conf['min_polies'],
+                                         self.conf['max_poly_points'],
+                                         self.conf['alpha_mutations'],
+                                         self.rng)
+        return [create_random_poly(self.w,
+                                   self.h,
+                                   self.conf['min_poly_points'],
+                                   self.conf['locality'],
+                                   self.conf['alpha_mutations'],
+                                   self.rng)
+                for i in range(self.conf['min_polies'])]
 
     def __getstate__(self):
         result = self.__dict__.copy()
         del result['context']
         del result['surface']
+        for phase, name in PROFILED:
+            result.pop(name, None)
+        result['polies'] = Genome.from_polies(self.polies,
+                                              self.conf['max_polies'],
+                                              self.conf['max_poly_points'])
+        result['_layers'] = []
+        result['_new_layers'] = None
+        result['_journal'] = None
+        result['_index'] = None
+        for key in ['_diff', '_image', '_new_image', '_spare_layers']:
+            result[key] = None
+        # the reference image is loaded again by self._ref
+        if result.get('_ref') is not None:
+            result['ref_image'] = result['_native_ref'] = None
         return result
 
     def __setstate__(self, dict):
         self.__dict__ = dict
+        if isinstance(self.polies, Genome):
+            self.polies = self.polies.to_polies()
+        self.__dict__.setdefault('_native_ref', self.ref_image)
+        self.__dict__.setdefault('level', 0)
+        if self._native_ref is None:
+            native_ref = self._ref.load(self.conf.get('ref_cache'))
+            self._native_ref = native_ref.view(np.ndarray)
+            self.ref_image = downsample(self._native_ref, self.level)
+        self.__dict__.setdefault('scale', 1.0)
+        self.__dict__.setdefault('_fired', [])
+        self.__dict__.setdefault('_parent_error', None)
+        self.__dict__.setdefault('_adapt_stats', {})
+        self.__dict__.setdefault('profile', None)
+        self.__dict__.setdefault('rng', np.random.RandomState())
+        self.__dict__.setdefault('_random', RandomBlocks(self.rng))
+        if self.profile:
+            self._wrap_profiled()
+        if isinstance(self.errors, list):
+            self.errors = Series.from_values(self.errors)
+            self.selections = Series.from_values(self.selections)
+        self.surface = cairo.ImageSurface(cairo.FORMAT_RGB24, self.w, self.h)
+        self.context = cairo.Context(self.surface)
+        self._invalidate_cache()
+        self._allocate_buffers()
+
+    def set_image_file(self, image_file):
+        """load the reference image from image_file (a copy of the image)
+            when the drawing is unpickled and the cache is gone, a relative
+            path is relative to the pickle (see refstore.load_pickle)
+        """
+        self._ref = refstore.ImageRef(image_file, self._ref.sha)
+
+    def _wrap_profiled(self):
+        """record the time of every call of the PROFILED methods"""
+        for phase, name in PROFILED:
+            setattr(self, name, self.profile.timed(phase, getattr(self, name)))
+
+    def _allocate_buffers(self):
+        """scratch buffers to evaluate the drawing without allocations"""
+        self._diff = np.empty((self.h, self.w, 3), np.int32)
+        self._image = np.empty((self.h, self.w, 4), np.uint8)
+        self._new_image = np.empty((self.h, self.w, 4), np.uint8)
+        # unused layer images of the render cache, to be recycled
+        self._spare_layers = []
+        # error of the accepted drawing in tiles of heatmap_tile pixels
+        self._heat = None
+        self._heat_tables = None
+        if self.conf.get('error_heatmap'):
+            tile = self.conf.get('heatmap_tile', 16)
+            self._heat = np.zeros((-(-self.h // tile), -(-self.w // tile)))
+
+    def set_level(self, level):
+        """continue the evolution on the image downsampled by 2**level
+
+            the reference image is downsampled by averaging blocks of pixels
+            and the polygons are rescaled to the new resolution. Level 0 is
+            the original image.
+        """
+        factor = 2 ** level
+        self.ref_image = downsample(self._native_ref, level)
+        self.h, self.w = self.ref_image.shape[:2]
+        for poly in self.polies:
+            if level < self.level:
+                up = 2 ** (self.level - level)
+                points = [(x * up, y * up) for x, y in poly['points']]
+            else:
+                down = float(2 ** (level - self.level))
+                points = [(x / down, y / down) for x, y in poly['points']]
+            poly['points'] = [(min(self.w, x), min(self.h, y)) for x, y in points]
+        self.level = level
+        self.scale = 1.0 / factor
         self.surface = cairo.ImageSurface(cairo.FORMAT_RGB24, self.w, self.h)
         self.context = cairo.Context(self.surface)
+        self._journal = None
+        self._invalidate_cache()
+        self._allocate_buffers()
+
+    def _spare_layer(self):
+        """an unused image for the render cache"""
+        if self._spare_layers:
+            return self._spare_layers.pop()
+        return np.empty((self.h, self.w, 4), np.uint8)
+
+    def _invalidate_cache(self):
+        """forget everything that was cached about the rendered polygons"""
+        # render cache, self._layers[i] is the image with only the first i
+        # polygons drawn. Polygons below self.dirty_idx did not change since
+        # the cache was filled, so we only have to redraw the ones above
+        if getattr(self, '_spare_layers', None) is not None:
+            self._spare_layers.extend(self._layers)
+            if self._new_layers is not None:
+                self._spare_layers.extend(self._new_layers[self._new_start + 1:])
+        self._layers = []
+        self._new_layers = None
+        self._new_start = 0
+        self.dirty_idx = 0
+        # bounding boxes of the polygons, built when first used
+        self._index = None
+        self._old_dirty_idx = 0
+        # incremental error, only the pixels in self.dirty_rect changed
+        # since self._error was computed for the image self._image
+        self.dirty_rect = None
+        self._old_dirty_rect = None
+        self._error = None
+        self._new_error = None
+        self._evaluated = False
+
+    def _commit(self):
+        """accept the last evaluated mutation (it was not reverted)"""
+        if not self._evaluated:
+            return
+        if self._new_layers is not None:
+            self._spare_layers.extend(self._layers[self._new_start + 1:])
+            self._layers = self._new_layers
+            self._new_layers = None
+        if self._new_error is not None:
+            x0, y0, x1, y1 = self.dirty_rect
+            self._image[y0:y1, x0:x1] = self._new_image[y0:y1, x0:x1]
+            self._error = self._new_error
+            self._new_error = None
+            if self._heat is not None:
+                self._update_heat(self.dirty_rect)
+        self.dirty_idx = len(self.polies)
+        self.dirty_rect = None
+        self._evaluated = False
+
+    def _touch(self, idx, rect):
+        """mark polygon idx (and all above) and the rect as changed"""
+        self.dirty_idx = min(self.dirty_idx, idx)
+        self.dirty_rect = union_rect(self.dirty_rect, rect)
+
+    def _update_heat(self, rect):
+        """recompute the error of the tiles that overlap rect from the
+            accepted image self._image
+        """
+        tile = self.conf.get('heatmap_tile', 16)
+        tx0, ty0 = rect[0] // tile, rect[1] // tile
+        tx1, ty1 = -(-rect[2] // tile), -(-rect[3] // tile)
+        x0, y0 = tx0 * tile, ty0 * tile
+        x1, y1 = min(self.w, tx1 * tile), min(self.h, ty1 * tile)
+        diff = self._diff[0:y1-y0, 0:x1-x0]
+        np.subtract(self.ref_image[y0:y1, x0:x1], self._image[y0:y1, x0:x1, 0:3],
+                    out=diff, dtype=np.int32)
+        np.multiply(diff, diff, out=diff)
+        pixels = diff.sum(axis=2)
+        rows = np.add.reduceat(pixels, np.arange(0, y1 - y0, tile), axis=0)
+        self._heat[ty0:ty1, tx0:tx1] = np.add.reduceat(
+            rows, np.arange(0, x1 - x0, tile), axis=1)
+        self._heat_tables = None
+
+    def _heatmap(self):
+        """the heatmap as tuple (weights, cdf) for the targeted mutations
+
+            weights[ty][tx] is how much more often a point in the tile is
+            moved than on average, cdf the cumulative error of the tiles.
+            None if there is no heatmap (yet).
+        """
+        if self._heat is None or not self._heat.any():
+            return None
+        if self._heat_tables is None:
+            bias = self.conf.get('heatmap_bias', 0.5)
+            heat = self._heat
+            weights = (1 - bias) + bias * heat / heat.mean()
+            self._heat_tables = (weights.tolist(), np.cumsum(heat.ravel()))
+        return self._heat_tables
+
+    def _target_region(self, cdf):
+        """pixel rectangle around a tile drawn with a probability that is
+            proportional to its error, or the whole image (see heatmap_bias)
+        """
+        u = self._random.uniform(2)
+        if u[0] >= self.conf.get('heatmap_bias', 0.5):
+            return 0, 0, self.w, self.h
+        tile = self.conf.get('heatmap_tile', 16)
+        idx = min(len(cdf) - 1, int(np.searchsorted(cdf, u[1] * cdf[-1],
+                                                    side='right')))
+        ty, tx = divmod(idx, self._heat.shape[1])
+        # the tile and its neighbours
+        return (max(0, (tx - 1) * tile), max(0, (ty - 1) * tile),
+                min(self.w, (tx + 2) * tile), min(self.h, (ty + 2) * tile))
+
+    def spatial_index(self):
+        """GridIndex of the bounding boxes of the polygons (see spatial.py)
+
+            built on the first call, from then on the mutations keep it up
+            to date until the polygons are replaced (set_polies, set_level)
+        """
+        if self._index is None:
+            self._index = GridIndex()
+            for poly in self.polies:
+                self._index.move(poly, poly_bbox(poly, self.w, self.h))
+        return self._index
+
+    def _reindex(self, poly, old_rect, new_rect, journal):
+        """move poly to new_rect in the spatial index (None: not in the
+            drawing), the journal moves it back on revert
+        """
+        if self._index is not None and old_rect != new_rect:
+            self._index.move(poly, new_rect)
+            journal((self._index.move, poly, old_rect))
+
+    def _adapt(self, accepted):
+        """update the rates of the operators used in the last mutation
+
+            after conf['adapt_window'] uses of an operator its rate grows if
+            the mutations it took part in improved the drawing more often
+            than mutations in general and shrinks otherwise. The step sizes
+            follow the 1/5th success rule: they grow if more than a fifth of
+            the point (color) moves improved the drawing.
+        """
+        fired, self._fired = self._fired, []
+        if not self.conf.get('adaptive_rates') or not fired:
+            return
+        success = accepted and (self._parent_error is None or
+                                self.errors.last < self._parent_error)
+        window = self.conf.get('adapt_window', 100)
+        total = self._adapt_stats.setdefault('total', [0, 0])
+        total[0] += 1
+        total[1] += success
+        if total[0] >= 10 * window:
+            # forget old mutations, success gets rarer during the evolution
+            total[:] = [total[0] / 2, total[1] / 2]
+        for rate in set(fired):
+            stats = self._adapt_stats.setdefault(rate, [0, 0])
+            stats[0] += 1
+            stats[1] += success
+            if stats[0] < window:
+                continue
+            if stats[1] * total[0] > total[1] * stats[0]:
+                factor = ADAPT_FACTOR
+            else:
+                factor = 1 / ADAPT_FACTOR
+            self.conf[rate] = min(RATE_BOUNDS[1],
+                                  max(RATE_BOUNDS[0], self.conf[rate] * factor))
+            if rate in ADAPTIVE_STEPS:
+                step = ADAPTIVE_STEPS[rate]
+                if stats[1] > ADAPT_SUCCESS * stats[0]:
+                    factor = ADAPT_FACTOR
+                else:
+                    factor = 1 / ADAPT_FACTOR
+                low, high = STEP_BOUNDS[step]
+                self.conf[step] = min(high, max(low, self.conf[step] * factor))
+            stats[:] = [0, 0]
+
+    def adapted_rates(self):
+        """the current values of the adaptive rates and step sizes"""
+        keys = ADAPTIVE_RATES + ADAPTIVE_STEPS.values()
+        return dict((key, self.conf[key]) for key in keys)
+
+    def reseed(self, seed):
+        """start the random numbers of the drawing again from seed"""
+        self.rng.seed(seed)
+        self._random.clear()
 
     def mutate(self):
         """mutate the current drawing"""
+        self._start_mutation()
+        if self.conf.get('random_blocks'):
+            self._mutate_blocks(self._journal.append, self._fired.append)
+        else:
+            self._mutate_scalar(self._journal.append, self._fired.append)
 
+    def _start_mutation(self):
+        """start a new generation with an empty journal"""
+
+        # the last mutation was not reverted
+        self._adapt(True)
+        self._commit()
+        self._parent_error = self.errors.last
         self.generations += 1
         self.selections.append(self.generations)
-        self.old_polies = copy.deepcopy(self.polies)
+        # the journal collects the operations that undo this mutation
+        self._journal = []
+        self._old_dirty_idx = self.dirty_idx
+        self._old_dirty_rect = self.dirty_rect
+
+    def refit_colors(self):
+        """set every polygon to the mean color of the reference image where
+            it is visible, the best colors for the current shapes and order
+
+            this is a mutation that has to be evaluated and can be reverted,
+            it only works for opaque polygons. Returns False (and does not
+            change anything) if the drawing has transparent polygons.
+        """
+        if any(poly['color'][3] < 1 for poly in self.polies):
+            return False
+        ids = raster.visible_polies(self.polies, self.w, self.h)
+        means = raster.mean_colors(ids, self.ref_image, len(self.polies))
+        self._start_mutation()
+        for poly_idx, (poly, bgr) in enumerate(zip(self.polies, means)):
+            if np.isnan(bgr[0]):
+                # hidden by the polygons above it
+                continue
+            color = (float(bgr[2]) / 255, float(bgr[1]) / 255,
+                     float(bgr[0]) / 255, 1)
+            if color != tuple(poly['color']):
+                self._journal.append((poly.__setitem__, 'color', poly['color']))
+                poly['color'] = color
+                self._touch(poly_idx, poly_bbox(poly, self.w, self.h))
+        return True
+
+    def _mutate_scalar(self, journal, fired):
+        """mutate with one random number drawn at a time"""
+        random, randint = self.rng.random_sample, self.rng.randint
 
         # insert new polygons
         if random() < self.conf['poly_rate']:
@@ -114,23 +634,45 @@ class Drawing(object):
                                           self.h,
                                           self.conf['min_poly_points'],
                                           self.conf['locality'],
-                                          self.conf['alpha_mutations'])
+                                          self.conf['alpha_mutations'],
+                                          self.rng)
                 self.polies.insert(rand_idx, poly)
+                journal((self.polies.pop, rand_idx))
+                fired('poly_rate')
+                rect = poly_bbox(poly, self.w, self.h)
+                self._touch(rand_idx, rect)
+                self._reindex(poly, None, rect, journal)
 
         # remove polygons
         if random() < self.conf['poly_rate']:
             if len(self.polies) > self.conf['min_polies']:
-                    self.polies.remove(choice(self.polies))
+                    rand_idx = randint(len(self.polies))
+                    poly = self.polies.pop(rand_idx)
+                    journal((self.polies.insert, rand_idx, poly))
+                    fired('poly_rate')
+                    rect = poly_bbox(poly, self.w, self.h)
+                    self._touch(rand_idx, rect)
+                    self._reindex(poly, rect, None, journal)
 
         # move polygons in the order in which they are drawn
         if random() < self.conf['move_poly_rate']:
             r1 = randint(0, len(self.polies))
             r2 = randint(0, len(self.polies))
             self.polies[r2], self.polies[r1] = self.polies[r1], self.polies[r2]
+            journal((self._swap_polies, r1, r2))
+            fired('move_poly_rate')
+            if r1 != r2:
+                self._touch(min(r1, r2),
+                            union_rect(poly_bbox(self.polies[r1], self.w, self.h),
+                                       poly_bbox(self.polies[r2], self.w, self.h)))
+
+        # points move less on the downsampled image
+        move_point = max(1, int(round(self.conf['move_point'] * self.scale)))
 
         # and now also mutate some of the polygons
-        for poly in self.polies:
+        for poly_idx, poly in enumerate(self.polies):
             if random() < self.conf['mutation_rate']:
+                old_rect = poly_bbox(poly, self.w, self.h)
 
                 # add points
                 if random() < self.conf['point_rate']:
@@ -138,63 +680,332 @@ class Drawing(object):
                         rand_idx = randint(0, len(poly['points']))
                         rand_point = (randint(0, self.w), randint(0, self.h))
                         poly['points'].insert(rand_idx, rand_point)
+                        journal((poly['points'].pop, rand_idx))
+                        fired('point_rate')
 
                 # remove a point from the polygon
                 if random() < self.conf['point_rate']:
                     if len(poly['points']) > 3:
-                        poly['points'].remove(choice(poly['points']))
+                        rand_idx = randint(len(poly['points']))
+                        point = poly['points'].pop(rand_idx)
+                        journal((poly['points'].insert, rand_idx, point))
+                        fired('point_rate')
 
                 # move some of the points
                 for i in range(len(poly['points'])):
                     if random() < self.conf['move_point_rate']:
-                        move = randint(-self.conf['move_point'],
-                                        self.conf['move_point'],
-                                        2)
+                        move = randint(-move_point, move_point, 2)
                         x = min(self.w, max(0, poly['points'][i][0] + move[0]))
                         y = min(self.h, max(0, poly['points'][i][1] + move[1]))
+                        journal((poly['points'].__setitem__, i,
+                                 poly['points'][i]))
                         poly['points'][i] = (x, y)
+                        fired('move_point_rate')
 
                 # mutate color of polygon
                 if random() < self.conf['color_rate']:
                     tmp = np.zeros(len(poly['color']))
                     for i in range(3):
-                        move = normal(0, self.conf['color_std'])
+                        move = self.rng.normal(0, self.conf['color_std'])
                         tmp[i] = min(1, max(0, poly['color'][i] + move))
-                    move = normal(0, self.conf['color_std'])
+                    move = self.rng.normal(0, self.conf['color_std'])
                     if self.conf['alpha_mutations']:
                         tmp[3] = min(0.6, max(0.3, poly['color'][3] + move))
                     else:
                         tmp[3] = 1
+                    journal((poly.__setitem__, 'color', poly['color']))
                     poly['color'] = tuple(tmp)
+                    fired('color_rate')
 
-    def evaluate(self):
-        """draw the polygons in a numpy array"""
+                new_rect = poly_bbox(poly, self.w, self.h)
+                self._touch(poly_idx, union_rect(old_rect, new_rect))
+                self._reindex(poly, old_rect, new_rect, journal)
 
-        self.context.set_source_rgb(1, 1, 1)
-        self.context.paint()
-        # draw the polygons
-        for poly in self.polies:
-            draw_poly(self.context, poly)
+    def _mutate_blocks(self, journal, fired):
+        """mutate with the random numbers taken from self._random
 
-        im_ar = to_numpy(self.surface)
-        # sum of square differences as fitness (error) function
-        error = np.sum((self.ref_image-im_ar)**2)
+            the mutations have the same distribution as in _mutate_scalar,
+            but the random numbers come from blocks that were drawn at once
+            and random integers are computed as int(u * n) from the uniform
+            numbers u. All numbers of a step are taken with one call and
+            compared as python floats, for the few numbers of a mutation
+            this is much faster than numpy arrays.
+        """
+        conf = self.conf
+        polies, w, h = self.polies, self.w, self.h
+        n_polies = len(polies)
+        u = self._random.uniform(8 + n_polies)
+        heatmap = self._heatmap()
+
+        # insert new polygons
+        if u[0] < conf['poly_rate'] and n_polies < conf['max_polies']:
+            rand_idx = int(u[1] * n_polies)
+            x0, y0, x1, y1 = (self._target_region(heatmap[1]) if heatmap
+                              else (0, 0, w, h))
+            poly = create_random_poly(x1 - x0, y1 - y0,
+                                      conf['min_poly_points'],
+                                      conf['locality'],
+                                      conf['alpha_mutations'],
+                                      self.rng)
+            if x0 or y0:
+                poly['points'] = [(x + x0, y + y0) for x, y in poly['points']]
+            polies.insert(rand_idx, poly)
+            journal((polies.pop, rand_idx))
+            fired('poly_rate')
+            rect = poly_bbox(poly, w, h)
+            self._touch(rand_idx, rect)
+            self._reindex(poly, None, rect, journal)
+
+        # remove polygons
+        if u[2] < conf['poly_rate'] and len(polies) > conf['min_polies']:
+            rand_idx = int(u[3] * len(polies))
+            poly = polies.pop(rand_idx)
+            journal((polies.insert, rand_idx, poly))
+            fired('poly_rate')
+            rect = poly_bbox(poly, w, h)
+            self._touch(rand_idx, rect)
+            self._reindex(poly, rect, None, journal)
+
+        # move polygons in the order in which they are drawn
+        if u[4] < conf['move_poly_rate']:
+            r1 = int(u[5] * len(polies))
+            r2 = int(u[6] * len(polies))
+            polies[r2], polies[r1] = polies[r1], polies[r2]
+            journal((self._swap_polies, r1, r2))
+            fired('move_poly_rate')
+            if r1 != r2:
+                self._touch(min(r1, r2),
+                            union_rect(poly_bbox(polies[r1], w, h),
+                                       poly_bbox(polies[r2], w, h)))
+
+        # and now also mutate some of the polygons
+        mutation_rate = conf['mutation_rate']
+        selected = [i for i, x in enumerate(u[7:7 + len(polies)])
+                    if x < mutation_rate]
+        if not selected:
+            return
+        point_rate, move_point_rate = conf['point_rate'], conf['move_point_rate']
+        color_rate, color_std = conf['color_rate'], conf['color_std']
+        # points move less on the downsampled image
+        move_point = max(1, int(round(conf['move_point'] * self.scale)))
+        if heatmap:
+            weights, tile = heatmap[0], conf.get('heatmap_tile', 16)
+        for poly_idx in selected:
+            poly = polies[poly_idx]
+            points = poly['points']
+            old_rect = poly_bbox(poly, w, h)
+            # add point (decision, position, x, y), remove point (decision,
+            # position), color and for every point: move it, x and y move
+            n_points = len(points) + 1
+            r = self._random.uniform(7 + 3 * n_points)
+
+            # add points
+            if r[0] < point_rate and len(points) < conf['max_poly_points']:
+                rand_idx = int(r[1] * len(points))
+                x0, y0, x1, y1 = (self._target_region(heatmap[1]) if heatmap
+                                  else (0, 0, w, h))
+                points.insert(rand_idx, (x0 + int(r[2] * (x1 - x0)),
+                                         y0 + int(r[3] * (y1 - y0))))
+                journal((points.pop, rand_idx))
+                fired('point_rate')
+
+            # remove a point from the polygon
+            if r[4] < point_rate and len(points) > 3:
+                rand_idx = int(r[5] * len(points))
+                point = points.pop(rand_idx)
+                journal((points.insert, rand_idx, point))
+                fired('point_rate')
+
+            # move some of the points
+            for i in range(len(points)):
+                rate = move_point_rate
+                if heatmap:
+                    # more moves where the error is high
+                    x, y = points[i]
+                    rate *= weights[min(int(y), h - 1) // tile][
+                        min(int(x), w - 1) // tile]
+                if r[7 + i] < rate:
+                    x, y = points[i]
+                    move_x = int(r[7 + n_points + i] * 2 * move_point) - move_point
+                    move_y = int(r[7 + 2 * n_points + i] * 2 * move_point) - move_point
+                    journal((points.__setitem__, i, points[i]))
+                    points[i] = (min(w, max(0, x + move_x)),
+                                 min(h, max(0, y + move_y)))
+                    fired('move_point_rate')
+
+            # mutate color of polygon
+            if r[6] < color_rate:
+                color, change = poly['color'], self._random.normal(4)
+                if conf['alpha_mutations']:
+                    alpha = min(0.6, max(0.3, color[3] + change[3] * color_std))
+                else:
+                    alpha = 1
+                journal((poly.__setitem__, 'color', color))
+                poly['color'] = (min(1.0, max(0.0, color[0] + change[0] * color_std)),
+                                 min(1.0, max(0.0, color[1] + change[1] * color_std)),
+                                 min(1.0, max(0.0, color[2] + change[2] * color_std)),
+                                 alpha)
+                fired('color_rate')
+
+            new_rect = poly_bbox(poly, w, h)
+            self._touch(poly_idx, union_rect(old_rect, new_rect))
+            self._reindex(poly, old_rect, new_rect, journal)
+
+    def evaluate(self, bound=None):
+        """draw the polygons in a numpy array
+
+            bound -- with conf['early_abort'] the error computation stops as
+                     soon as the error is larger than bound and REJECTED is
+                     returned, the mutation then has to be reverted
+        """
+
+        self._render()
+        self._evaluated = True
+        if not self.conf.get('early_abort'):
+            bound = None
+        error, complete = self._compute_error(bound)
+        # a rejected mutation is reverted, which removes the partial error
         self.errors.append(error)
-        return error
+        return error if complete else REJECTED
 
-    def get_sorted_polies(self, write_to_disk=None):
-        """sort the polygons according to their contribution"""
-        error = self.evaluate()
-        for to_del_poly in self.polies:
-            polies_copy = copy.deepcopy(self.polies)
-            polies_copy.remove(to_del_poly)
+    def _render(self):
+        """draw the polygons on the surface"""
+        if self.conf.get('render_cache'):
+            self._render_cached()
+        else:
+            self.context.set_source_rgb(1, 1, 1)
+            self.context.paint()
+            # draw the polygons
+            for poly in self.polies:
+                draw_poly(self.context, poly)
+
+    def _compute_error(self, bound=None):
+        """error of the drawing on the surface as tuple (error, complete)
+
+            see bounded_ssd for complete
+        """
+        if self.conf.get('incremental_error'):
+            return self._incremental_error(bound)
+        self.surface.flush()
+        im_ar = surface_array(self.surface)[:,:,0:3]
+        # sum of square differences as fitness (error) function
+        if bound is None:
+            return ssd(self.ref_image, im_ar, self._diff), True
+        return bounded_ssd(self.ref_image, im_ar, self._diff, bound,
+                           self.conf.get('abort_rows', 16))
+
+    def _incremental_error(self, bound=None):
+        """update the error of the last accepted drawing by the change of
+            the error in the dirty rectangle, the only part that changed
+        """
+        self.surface.flush()
+        buf = surface_array(self.surface)
+        if self._error is None:
+            # nothing to start from, the whole image is new
+            self.dirty_rect = (0, 0, self.w, self.h)
+            self._new_image[:] = buf
+            self._new_error = ssd(self.ref_image, buf[:,:,0:3], self._diff)
+            return self._new_error, True
+        if self.dirty_rect is None:
+            self._new_error = None
+            return self._error, True
+        x0, y0, x1, y1 = self.dirty_rect
+        ref = self.ref_image[y0:y1, x0:x1]
+        diff = self._diff[0:y1-y0, 0:x1-x0]
+        new_image = self._new_image[y0:y1, x0:x1]
+        new_image[:] = buf[y0:y1, x0:x1]
+        old_error = ssd(ref, self._image[y0:y1, x0:x1, 0:3], diff)
+        if bound is None:
+            new_error = ssd(ref, new_image[:,:,0:3], diff)
+        else:
+            # the error outside of the rectangle does not change
+            new_error, complete = bounded_ssd(ref, new_image[:,:,0:3], diff,
+                                              bound - self._error + old_error,
+                                              self.conf.get('abort_rows', 16))
+            if not complete:
+                self._new_error = None
+                return self._error - old_error + new_error, False
+        self._new_error = self._error - old_error + new_error
+        return self._new_error, True
+
+    def evaluate_batch(self, candidates):
+        """errors of a list of K candidate polygon lists as (K,) array
+
+            the candidates are rendered with numpy instead of cairo, see
+            raster.py for how much the result differs from evaluate
+        """
+        samples = self.conf.get('raster_samples', raster.SAMPLES)
+        return raster.batch_errors(candidates, self.ref_image, samples)
+
+    def _render_cached(self):
+        """render the drawing starting from the cached unchanged layers
+
+            the resulting surface is exactly the same as when all polygons
+            are drawn on a white background. The layers of the new drawing
+            are kept in self._new_layers until the mutation is accepted.
+        """
+        buf = surface_array(self.surface)
+        if not self._layers:
             self.context.set_source_rgb(1, 1, 1)
             self.context.paint()
-            for poly in polies_copy:
+            self.surface.flush()
+            self._layers = [self._spare_layer()]
+            self._layers[0][:] = buf
+            self.dirty_idx = 0
+        if self._new_layers is not None:
+            # the layers of an earlier evaluation of the same mutation
+            self._spare_layers.extend(self._new_layers[self._new_start + 1:])
+        start = min(self.dirty_idx, len(self._layers) - 1)
+        buf[:] = self._layers[start]
+        self.surface.mark_dirty()
+        new_layers = self._layers[:start + 1]
+        for poly in self.polies[start:]:
+            draw_poly(self.context, poly)
+            self.surface.flush()
+            layer = self._spare_layer()
+            layer[:] = buf
+            new_layers.append(layer)
+        self._new_layers = new_layers
+        self._new_start = start
+
+    def get_sorted_polies(self, write_to_disk=None):
+        """sort the polygons according to their contribution
+
+            the contribution of a polygon is the change of the error when it
+            is removed from the drawing. Without the polygon only the pixels
+            in its bounding box change, so they are rendered starting from
+            the image of the polygons below it and only the polygons above
+            it that overlap the box have to be drawn again.
+        """
+        error = self.evaluate()
+        buf = surface_array(self.surface)
+        # prefix[i] is the image of the first i polygons
+        self.context.set_source_rgb(1, 1, 1)
+        self.context.paint()
+        prefix = []
+        for poly in self.polies + [None]:
+            self.surface.flush()
+            prefix.append(self._spare_layer())
+            prefix[-1][:] = buf
+            if poly is not None:
                 draw_poly(self.context, poly)
-            im_ar = to_numpy(self.surface)
-            tmp_error = np.sum((self.ref_image-im_ar)**2)
+        full_image = prefix[-1]
+        index = self.spatial_index()
+        position = dict((id(poly), i) for i, poly in enumerate(self.polies))
+        for del_idx, to_del_poly in enumerate(self.polies):
+            x0, y0, x1, y1 = rect = index.rect(to_del_poly)
+            buf[y0:y1, x0:x1] = prefix[del_idx][y0:y1, x0:x1]
+            self.surface.mark_dirty()
+            above = [position[id(poly)] for poly in index.query(rect)]
+            for i in sorted(i for i in above if i > del_idx):
+                draw_poly(self.context, self.polies[i])
+            self.surface.flush()
+            ref = self.ref_image[y0:y1, x0:x1]
+            diff = self._diff[0:y1-y0, 0:x1-x0]
+            tmp_error = (error - ssd(ref, full_image[y0:y1, x0:x1, 0:3], diff)
+                         + ssd(ref, buf[y0:y1, x0:x1, 0:3], diff))
             to_del_poly['error'] = np.abs(error-tmp_error)
+        self._spare_layers.extend(prefix)
         idx = np.argsort([p['error'] for p in self.polies])
         if write_to_disk:
             ssum = sum([p['error'] for p in self.polies])
@@ -210,10 +1021,86 @@ class Drawing(object):
             poly['position'] = i
         return [self.polies[i] for i in idx]
 
+    def set_polies(self, polies):
+        """replace all polygons of the drawing (invalidates the caches)"""
+        self.polies = polies
+        self._journal = None
+        self._fired = []
+        self._invalidate_cache()
+
+    def get_checkpoint(self):
+        """the compact state of the evolution (without the reference image)
+
+            together with the image and conf this is all that is needed to
+            continue the evolution exactly as if it was never interrupted.
+            The last evaluated mutation counts as accepted.
+        """
+        # the heatmap must include the last accepted mutation
+        self._commit()
+        return {"polies": Genome.from_polies(self.polies,
+                                             self.conf['max_polies'],
+                                             self.conf['max_poly_points']),
+                "level": self.level,
+                "generations": self.generations,
+                "selections": self.selections,
+                "errors": self.errors,
+                "rates": (self.adapted_rates(), self._adapt_stats,
+                          self._fired, self._parent_error),
+                "random_state": self.rng.get_state(),
+                "random_blocks": self._random.get_state(),
+                "heatmap": self._heat}
+
+    def set_checkpoint(self, checkpoint):
+        """continue the evolution from a state created by get_checkpoint"""
+        if checkpoint.get('level', 0) != self.level:
+            self.set_level(checkpoint['level'])
+        self.set_polies(checkpoint['polies'].to_polies())
+        self.generations = checkpoint['generations']
+        self.selections = checkpoint['selections']
+        self.errors = checkpoint['errors']
+        if 'rates' in checkpoint:
+            self.conf.update(checkpoint['rates'][0])
+            self._adapt_stats = checkpoint['rates'][1]
+            self._fired, self._parent_error = checkpoint['rates'][2:]
+        state = checkpoint['random_state']
+        if len(state) == 2:
+            # checkpoints of older versions, the global numpy and python state
+            state = state[0]
+        self.rng.set_state(state)
+        self._random.clear()
+        if 'random_blocks' in checkpoint:
+            self._random.set_state(checkpoint['random_blocks'])
+        heat = checkpoint.get('heatmap')
+        if self._heat is not None and heat is not None:
+            self._heat[:] = heat
+            self._heat_tables = None
+
+    def accept_offspring(self, polies, error):
+        """take over the polygons of an offspring that was mutated and
+            evaluated outside of this drawing (e.g. in a worker process)
+        """
+        self.set_polies(polies)
+        self.selections.append(self.generations)
+        self.errors.append(error)
+
+    def _swap_polies(self, r1, r2):
+        """exchange the position of two polygons in the drawing order"""
+        self.polies[r2], self.polies[r1] = self.polies[r1], self.polies[r2]
+
     def revert_last_mutation(self):
         """make mutation undone (e.g. in case of worse performance)"""
-        if self.old_polies:
-            self.polies = self.old_polies
+        if self._journal is not None:
+            for undo in reversed(self._journal):
+                undo[0](*undo[1:])
+            self._journal = None
+            self._adapt(False)
+            if self._new_layers is not None:
+                self._spare_layers.extend(self._new_layers[self._new_start + 1:])
+            self._new_layers = None
+            self._new_error = None
+            self._evaluated = False
+            self.dirty_idx = self._old_dirty_idx
+            self.dirty_rect = self._old_dirty_rect
             self.errors.pop()
             self.selections.pop()
         else:
@@ -222,7 +1109,7 @@ class Drawing(object):
     def print_state(self):
         """print some information on the drawing to the logger"""
         logging.info("Mutation: %d, Selection: %d, error: %d"
-                % (self.generations, len(self.selections), self.errors[-1]))
+                % (self.generations, len(self.selections), self.errors.last))
 
     def as_array(self):
         """return a version of the rendered drawing as a numpy array"""
@@ -0,0 +1,166 @@
+"""profiling.py
+
+    where does the time of an evolution go
+
+    A Profile collects the durations of the phases of the evolution (mutate,
+    render, error, revert, writing snapshots, ...) in histograms with
+    logarithmic bins, so it stays small for any number of generations and
+    still gives percentiles. Profiles are exported as json dicts that can be
+    summed up over several images (summary).
+
+    The SamplingProfiler is a statistical profiler for the code that is not
+    covered by the phases: a timer signal interrupts the process every
+    interval seconds of cpu time and the functions on the stack are counted.
+"""
+
+import time
+import signal
+from contextlib import contextmanager
+from collections import defaultdict
+import numpy as np
+
+# histogram bins from 0.1 microseconds to 1000 seconds, 10 per decade
+BIN_EDGES = np.logspace(-7, 3, 101)
+PERCENTILES = [50, 90, 99]
+
+
+class Profile(object):
+    """histograms of the time spent in every phase"""
+
+    def __init__(self):
+        super(Profile, self).__init__()
+        self.phases = {}
+
+    def add(self, phase, seconds):
+        """record that phase took the given time once"""
+        if phase not in self.phases:
+            self.phases[phase] = {"count": 0, "total": 0.0, "max": 0.0,
+                                  "histogram": np.zeros(len(BIN_EDGES) + 1,
+                                                        np.int64)}
+        stats = self.phases[phase]
+        stats['count'] += 1
+        stats['total'] += seconds
+        stats['max'] = max(stats['max'], seconds)
+        stats['histogram'][np.searchsorted(BIN_EDGES, seconds)] += 1
+
+    def timed(self, phase, function):
+        """function that records the time of every call of function"""
+        def timed_function(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(phase, time.time() - start)
+        return timed_function
+
+    def to_dict(self):
+        """json serializable statistics of all phases"""
+        return dict((phase, phase_dict(stats['count'], stats['total'],
+                                       stats['max'], stats['histogram']))
+                    for phase, stats in self.phases.items())
+
+
+@contextmanager
+def phase(profile, name):
+    """record the time of the with block as phase name (if profile is set)"""
+    if profile is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        profile.add(name, time.time() - start)
+
+
+def percentile(histogram, q):
+    """estimate of the q-th percentile (in seconds) from a histogram
+
+        the geometric center of the bin that contains the percentile
+    """
+    histogram = np.asarray(histogram)
+    if histogram.sum() == 0:
+        return 0.0
+    idx = np.searchsorted(np.cumsum(histogram), q / 100.0 * histogram.sum())
+    edges = np.concatenate([[BIN_EDGES[0]], BIN_EDGES, [BIN_EDGES[-1]]])
+    return float(np.sqrt(edges[idx] * edges[idx + 1]))
+
+
+def phase_dict(count, total, maximum, histogram):
+    """the exported statistics of a phase"""
+    result = {"count": int(count),
+              "total": total,
+              "mean": total / count if count else 0.0,
+              "max": maximum,
+              "histogram": [int(n) for n in histogram]}
+    for q in PERCENTILES:
+        result['p%d' % q] = percentile(histogram, q)
+    return result
+
+
+def summary(profiles):
+    """sum up the exported phases (to_dict) of several profiles"""
+    totals = {}
+    for profile in profiles:
+        for name, stats in profile.items():
+            if name not in totals:
+                totals[name] = [0, 0.0, 0.0, np.zeros(len(stats['histogram']),
+                                                      np.int64)]
+            total = totals[name]
+            total[0] += stats['count']
+            total[1] += stats['total']
+            total[2] = max(total[2], stats['max'])
+            total[3] += stats['histogram']
+    return dict((name, phase_dict(*total)) for name, total in totals.items())
+
+
+class SamplingProfiler(object):
+    """count the functions on the stack every interval seconds (cpu time)
+
+        self: samples in which the function was running itself
+        cumulative: samples in which the function was on the stack
+        only works in the main thread and on systems with SIGPROF
+    """
+
+    def __init__(self, interval=0.01):
+        super(SamplingProfiler, self).__init__()
+        self.interval = interval
+        self.samples = 0
+        self.self_counts = defaultdict(int)
+        self.cumulative_counts = defaultdict(int)
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def _sample(self, signum, frame):
+        self.samples += 1
+        self.self_counts[_location(frame)] += 1
+        seen = set()
+        while frame is not None:
+            location = _location(frame)
+            if location not in seen:
+                self.cumulative_counts[location] += 1
+                seen.add(location)
+            frame = frame.f_back
+
+    def to_dict(self, top=30):
+        """the top functions by samples in a json serializable dict"""
+        def ranking(counts):
+            ranked = sorted(counts.items(), key=lambda item: -item[1])[:top]
+            return [{"function": location, "samples": n,
+                     "fraction": n / float(self.samples)}
+                    for location, n in ranked]
+        return {"interval": self.interval,
+                "samples": self.samples,
+                "self": ranking(self.self_counts),
+                "cumulative": ranking(self.cumulative_counts)}
+
+
+def _location(frame):
+    code = frame.f_code
+    return '%s:%d(%s)' % (code.co_filename, code.co_firstlineno, code.co_name)
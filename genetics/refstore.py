@@ -0,0 +1,101 @@
+"""refstore.py
+
+    reference images shared by all processes of a run
+
+    The reference image of a drawing is converted once to a uint8 BGR array
+    and stored as .npy file in a cache directory, named by the hash of the
+    image file. Every Drawing (also in the worker processes) maps this file
+    read-only into memory, so all processes share the same pages of the
+    operating system cache instead of holding their own copy. A pickled
+    Drawing only contains the path and hash of the image (see ImageRef), a
+    relative path is relative to the directory of the pickle if it is
+    loaded with load_pickle.
+"""
+
+import os
+import hashlib
+import pickle
+import tempfile
+import numpy as np
+import pylab as plt
+
+# the arrays already mapped in this process, by path of the image file
+_mapped = {}
+# directory of the pickle that is loaded by load_pickle
+_base_dir = ''
+
+
+def default_cache_dir():
+    """cache directory if conf['ref_cache'] is not set"""
+    return os.path.join(tempfile.gettempdir(), 'poly_burst_refs')
+
+
+def file_hash(fname):
+    """sha1 of the content of a file"""
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def read_image(image_file):
+    """the image as uint8 array of BGR values (the order cairo uses)"""
+    tmp = plt.imread(image_file.encode('ascii','ignore'))
+    return np.ascontiguousarray((tmp * 255).astype(np.uint8)[:,:,::-1])
+
+
+class ImageRef(object):
+    """path and hash of a reference image, what is pickled instead of it"""
+
+    def __init__(self, image_file, sha):
+        super(ImageRef, self).__init__()
+        self.image_file = image_file
+        self.sha = sha
+
+    def cache_file(self, cache_dir):
+        return os.path.join(cache_dir, self.sha + '.npy')
+
+    def load(self, cache_dir=None):
+        """map the cached array, it is created from the image if missing"""
+        cache_dir = cache_dir or default_cache_dir()
+        cache_file = self.cache_file(cache_dir)
+        if not os.path.exists(cache_file):
+            image_file = os.path.join(_base_dir, self.image_file)
+            if file_hash(image_file) != self.sha:
+                raise Exception('image %s changed since it was used (hash %s)'
+                                % (image_file, self.sha))
+            if not os.path.exists(cache_dir):
+                try:
+                    os.makedirs(cache_dir)
+                except OSError:
+                    # created by another process in the meantime
+                    pass
+            # write to a temporary file first, other processes must never
+            # see a half written array
+            fd, tmp_name = tempfile.mkstemp(dir=cache_dir, suffix='.npy')
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, read_image(image_file))
+            os.rename(tmp_name, cache_file)
+        return np.load(cache_file, mmap_mode='r')
+
+
+def load(image_file, cache_dir=None):
+    """the read-only uint8 BGR array of an image and its ImageRef"""
+    if image_file not in _mapped:
+        ref = ImageRef(image_file, file_hash(image_file))
+        _mapped[image_file] = (ref.load(cache_dir), ref)
+    return _mapped[image_file]
+
+
+def load_pickle(fname):
+    """unpickle a file, relative image files of the ImageRefs in it are
+        relative to the directory of the file
+    """
+    global _base_dir
+    _base_dir = os.path.dirname(os.path.abspath(fname))
+    try:
+        with open(fname, 'rb') as f:
+            return pickle.load(f)
+    finally:
+        _base_dir = ''
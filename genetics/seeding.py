@@ -0,0 +1,136 @@
+"""seeding.py
+
+    initial polygons that already follow the reference image
+
+    Random polygons (conf['init'] = 'random') have to find the image first,
+    which costs the first thousands of generations. The initializers here
+    place the polygons of a new drawing by the content of the image instead:
+
+    kmeans: the pixels are clustered by color and position (a simple form
+            of superpixels), every cluster becomes a polygon around its
+            pixels in the mean color of the cluster. Large clusters are
+            drawn first, so the small ones are not hidden by them.
+    gradient: a rectangle over the whole image in its mean color and on
+              top of it small polygons around points drawn with a
+              probability proportional to the gradient of the image, i.e.
+              on the edges, in the mean color of the image below them.
+
+    All random numbers are drawn from the RandomState of the drawing, the
+    polygons are dicts as created by pool.create_random_poly.
+"""
+
+import numpy as np
+
+INITS = ['random', 'kmeans', 'gradient']
+
+# pixels used to compute the clusters and iterations of k-means
+KMEANS_SAMPLES = 4096
+KMEANS_ITERATIONS = 10
+# weight of the position (relative to the color) in the k-means distance
+SPATIAL_WEIGHT = 1.0
+# radius of the gradient polygons relative to the smaller image side
+GRADIENT_RADIUS = 0.1
+
+
+def create_polies(init, ref_image, n_polies, n_points, alpha_mutations, rng):
+    """n_polies polygons with n_points points placed by the method init
+
+        ref_image -- (height, width, 3) uint8 BGR array of the image
+    """
+    if init == 'kmeans':
+        return kmeans_polies(ref_image, n_polies, n_points, alpha_mutations,
+                             rng)
+    if init == 'gradient':
+        return gradient_polies(ref_image, n_polies, n_points, alpha_mutations,
+                               rng)
+    raise Exception('unknown init %s, use one of %s' % (init, INITS))
+
+
+def make_poly(points, bgr, alpha_mutations, rng):
+    """polygon dict with the points and the mean color bgr (0 .. 255)"""
+    alpha = rng.uniform(0.3, 0.6) if alpha_mutations else 1
+    return {"points": [(int(x), int(y)) for x, y in points],
+            "color": (float(bgr[2]) / 255, float(bgr[1]) / 255,
+                      float(bgr[0]) / 255, alpha)}
+
+
+def outline(xs, ys, n_points):
+    """polygon around the points: the outermost point in each of n_points
+        sectors around their center, the bounding box if this gives less
+        than three points
+    """
+    cx, cy = xs.mean(), ys.mean()
+    angles = np.arctan2(ys - cy, xs - cx)
+    sectors = ((angles + np.pi) / (2 * np.pi) * n_points).astype(int) % n_points
+    distances = (xs - cx) ** 2 + (ys - cy) ** 2
+    points = []
+    for sector in range(n_points):
+        members = np.nonzero(sectors == sector)[0]
+        if len(members):
+            outer = members[np.argmax(distances[members])]
+            points.append((xs[outer], ys[outer]))
+    if len(set(points)) < 3:
+        x0, y0, x1, y1 = xs.min(), ys.min(), xs.max() + 1, ys.max() + 1
+        points = [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+    return points
+
+
+def kmeans_polies(ref_image, n_polies, n_points, alpha_mutations, rng):
+    """one polygon per cluster of the pixels in color and position"""
+    height, width = ref_image.shape[:2]
+    n_samples = min(KMEANS_SAMPLES, height * width)
+    idx = rng.choice(height * width, n_samples, replace=False)
+    ys, xs = np.divmod(idx, width)
+    colors = ref_image.reshape(-1, 3)[idx].astype(float)
+    features = np.column_stack([SPATIAL_WEIGHT * xs / float(width),
+                                SPATIAL_WEIGHT * ys / float(height),
+                                colors / 255])
+    k = min(n_polies, n_samples)
+    centers = features[rng.choice(n_samples, k, replace=False)]
+    for i in range(KMEANS_ITERATIONS):
+        distances = ((features[:,None,:] - centers[None,:,:]) ** 2).sum(axis=2)
+        labels = distances.argmin(axis=1)
+        for j in range(k):
+            members = labels == j
+            if members.any():
+                centers[j] = features[members].mean(axis=0)
+    sizes = np.bincount(labels, minlength=k)
+    polies = []
+    for j in np.argsort(-sizes, kind='mergesort'):
+        members = labels == j
+        if not members.any():
+            continue
+        polies.append(make_poly(outline(xs[members], ys[members], n_points),
+                                colors[members].mean(axis=0),
+                                alpha_mutations, rng))
+    return polies
+
+
+def gradient_polies(ref_image, n_polies, n_points, alpha_mutations, rng):
+    """background rectangle and small polygons around points drawn by the
+        gradient magnitude
+    """
+    height, width = ref_image.shape[:2]
+    background = make_poly([(0, 0), (width, 0), (width, height), (0, height)],
+                           ref_image.reshape(-1, 3).mean(axis=0),
+                           alpha_mutations, rng)
+    if n_polies < 2:
+        return [background][:n_polies]
+    gray = ref_image.astype(float).mean(axis=2)
+    gy, gx = np.gradient(gray)
+    magnitude = np.hypot(gx, gy).ravel() + 1e-6
+    centers = rng.choice(height * width, n_polies - 1,
+                         p=magnitude / magnitude.sum())
+    radius = max(2, GRADIENT_RADIUS * min(width, height))
+    polies = [background]
+    for center in centers:
+        cy, cx = divmod(center, width)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, n_points))
+        radii = radius * rng.uniform(0.5, 1, n_points)
+        xs = np.clip(np.rint(cx + radii * np.cos(angles)), 0, width)
+        ys = np.clip(np.rint(cy + radii * np.sin(angles)), 0, height)
+        x0, y0 = min(int(xs.min()), width - 1), min(int(ys.min()), height - 1)
+        x1, y1 = max(x0 + 1, int(xs.max())), max(y0 + 1, int(ys.max()))
+        bgr = ref_image[y0:y1, x0:x1].reshape(-1, 3).mean(axis=0)
+        polies.append(make_poly(zip(xs, ys), bgr, alpha_mutations, rng))
+    return polies
@@ -0,0 +1,66 @@
+"""spatial.py
+
+    which polygons are in which part of the image
+
+    A GridIndex divides the image in square cells of CELL_SIZE pixels and
+    keeps for every cell the polygons whose bounding box touches it. Which
+    polygons overlap a rectangle is then answered by looking only at the
+    cells of the rectangle instead of at all polygons. The polygons are kept
+    by identity (their dicts), so their position in the drawing order can
+    change without updating the index, only a changed bounding box has to
+    be moved (see Drawing.spatial_index).
+"""
+
+CELL_SIZE = 32
+
+
+class GridIndex(object):
+    """uniform grid over the bounding boxes (x0, y0, x1, y1) of items"""
+
+    def __init__(self, cell_size=CELL_SIZE):
+        super(GridIndex, self).__init__()
+        self.cell_size = cell_size
+        self.cells = {}
+        # id of the item -> (item, rect)
+        self.items = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def _cells(self, rect):
+        x0, y0, x1, y1 = rect
+        size = self.cell_size
+        return [(cx, cy)
+                for cx in range(x0 // size, max(x0, x1 - 1) // size + 1)
+                for cy in range(y0 // size, max(y0, y1 - 1) // size + 1)]
+
+    def rect(self, item):
+        """the rectangle of item, None if it is not in the index"""
+        return self.items.get(id(item), (None, None))[1]
+
+    def move(self, item, rect):
+        """set the rectangle of item, None removes it from the index"""
+        key = id(item)
+        if key in self.items:
+            for cell in self._cells(self.items.pop(key)[1]):
+                members = self.cells[cell]
+                members.discard(key)
+                if not members:
+                    del self.cells[cell]
+        if rect is not None:
+            self.items[key] = (item, rect)
+            for cell in self._cells(rect):
+                self.cells.setdefault(cell, set()).add(key)
+
+    def query(self, rect):
+        """the items whose rectangles have pixels in common with rect"""
+        x0, y0, x1, y1 = rect
+        keys = set()
+        for cell in self._cells(rect):
+            keys.update(self.cells.get(cell, ()))
+        result = []
+        for key in keys:
+            item, (ix0, iy0, ix1, iy1) = self.items[key]
+            if ix0 < x1 and x0 < ix1 and iy0 < y1 and y0 < iy1:
+                result.append(item)
+        return result
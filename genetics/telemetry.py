@@ -0,0 +1,124 @@
+"""telemetry.py
+
+    bounded storage for the history of an evolution
+
+    The errors and selections of a drawing grow with every accepted
+    mutation, for long runs this would be millions of values. A Series
+    stores them in a typed array of fixed size instead, when it is full
+    every second value is dropped (and from then on only every second
+    value is stored). So the history is downsampled more and more for
+    longer runs, but the number of values and the last value stay exact.
+"""
+
+import numpy as np
+import pylab as plt
+
+CAPACITY = 4096
+
+
+class Series(object):
+    """append-only series of numbers with automatic decimation
+
+        len() is the number of values appended so far, last the value
+        appended last. series() gives the stored (downsampled) values
+        together with their position in the complete series.
+    """
+
+    def __init__(self, capacity=CAPACITY, dtype=np.int64):
+        super(Series, self).__init__()
+        self.values = np.zeros(capacity, dtype)
+        self.index = np.zeros(capacity, np.int64)
+        self.n = 0
+        self.count = 0
+        self.stride = 1
+        self.last = None
+        self._prev_last = None
+
+    @classmethod
+    def from_values(cls, values, capacity=CAPACITY, dtype=np.int64):
+        """create a series from a list of values"""
+        series = cls(capacity, dtype)
+        for value in values:
+            series.append(value)
+        return series
+
+    def __len__(self):
+        return self.count
+
+    def append(self, value):
+        """add a value at the end of the series"""
+        if self.count % self.stride == 0 and self.n == len(self.values):
+            self._decimate()
+        if self.count % self.stride == 0:
+            self.values[self.n] = value
+            self.index[self.n] = self.count
+            self.n += 1
+        self.count += 1
+        self._prev_last, self.last = self.last, value
+
+    def pop(self):
+        """remove the value appended last and return it
+
+            only the value appended last is known exactly, after popping it
+            last is the value before it if it was stored or not popped yet
+        """
+        value = self.last
+        self.count -= 1
+        if self.n and self.index[self.n - 1] == self.count:
+            self.n -= 1
+        if self.n and self.index[self.n - 1] == self.count - 1:
+            self.last = self.values[self.n - 1]
+        else:
+            self.last = self._prev_last
+        self._prev_last = None
+        return value
+
+    def series(self):
+        """positions and values of the stored values, including the last"""
+        index, values = self.index[:self.n], self.values[:self.n]
+        if self.count and (not self.n or index[-1] != self.count - 1):
+            index = np.append(index, self.count - 1)
+            values = np.append(values, self.last)
+        return index, values
+
+    def _decimate(self):
+        """drop every second stored value"""
+        keep = (self.n + 1) // 2
+        self.values[:keep] = self.values[:self.n:2]
+        self.index[:keep] = self.index[:self.n:2]
+        self.n = keep
+        self.stride *= 2
+
+    def __getstate__(self):
+        """only pickle the used part of the arrays"""
+        state = self.__dict__.copy()
+        state['capacity'] = len(self.values)
+        state['values'] = self.values[:self.n].copy()
+        state['index'] = self.index[:self.n].copy()
+        return state
+
+    def __setstate__(self, state):
+        capacity = state.pop('capacity')
+        values, index = state['values'], state['index']
+        self.__dict__ = state
+        self.values = np.zeros(capacity, values.dtype)
+        self.values[:self.n] = values
+        self.index = np.zeros(capacity, np.int64)
+        self.index[:self.n] = index
+
+
+def plot_evolution(errors, selections, fname):
+    """plot the error and the number of mutations per selection
+
+        top: the error over the selections
+        bottom: number of mutations that took place between two selections
+    """
+    plt.figure()
+    plt.subplot(2, 1, 1)
+    plt.plot(*errors.series())
+    plt.subplot(2, 1, 2)
+    index, generations = selections.series()
+    # average over the selections that were dropped by the decimation
+    plt.plot(index[1:], np.diff(generations) / np.diff(index).astype(float))
+    plt.savefig(fname)
+    plt.close()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_main_batch.py
+
+the driver of the evolution: stop criteria and continuing from checkpoints
+"""
+
+import os
+import json
+import pickle
+import shutil
+import tempfile
+import unittest
+from poly_burst.genetics import main_batch
+from poly_burst.genetics import pool
+from poly_burst.genetics import refstore
+from test_pool import make_image, conf_file
+
+
+class FakeDrawing(object):
+    """what StopCriteria looks at"""
+
+    def __init__(self, generations=0, level=0):
+        self.generations = generations
+        self.level = level
+
+
+class TestStopCriteria(unittest.TestCase):
+
+    def test_plateau(self):
+        """stop when the error improved too little within the window"""
+        stop = main_batch.StopCriteria({'stop_window': 100,
+                                        'stop_epsilon': 0.01})
+        drawing = FakeDrawing()
+        self.assertEqual(stop.check(drawing, 1000, 0), None)
+        drawing.generations = 99
+        self.assertEqual(stop.check(drawing, 995, 0), None)
+        # 5% better after a full window, a new window starts
+        drawing.generations = 100
+        self.assertEqual(stop.check(drawing, 950, 0), None)
+        self.assertEqual(stop.start, (100, 950))
+        drawing.generations = 200
+        self.assertEqual(stop.check(drawing, 945, 0), 'plateau')
+
+    def test_target_error(self):
+        """the target error only counts on the original resolution"""
+        stop = main_batch.StopCriteria({'target_error': 500})
+        self.assertEqual(stop.check(FakeDrawing(level=1), 400, 0), None)
+        self.assertEqual(stop.check(FakeDrawing(), 501, 0), None)
+        self.assertEqual(stop.check(FakeDrawing(), 500, 0), 'target_error')
+
+    def test_time_budget(self):
+        """the time budget counts on every level"""
+        stop = main_batch.StopCriteria({'time_budget': 10})
+        self.assertEqual(stop.check(FakeDrawing(level=2), 1000, 9.9), None)
+        self.assertEqual(stop.check(FakeDrawing(level=2), 1000, 10), 'time_budget')
+        self.assertEqual(main_batch.StopCriteria({}).check(FakeDrawing(), 1, 1e9),
+                         None)
+
+    def test_reset(self):
+        """a level change starts a new window with the new error"""
+        stop = main_batch.StopCriteria({'stop_window': 100,
+                                        'stop_epsilon': 0.01})
+        self.assertEqual(stop.check(FakeDrawing(50, level=1), 100, 0), None)
+        self.assertEqual(stop.start, None)
+        stop.check(FakeDrawing(50), 1000, 0)
+        # the error on the finer level is on another scale
+        stop.reset(120, 4000)
+        self.assertEqual(stop.check(FakeDrawing(200), 3990, 0), None)
+        self.assertEqual(stop.check(FakeDrawing(220), 3990, 0), 'plateau')
+
+
+class TestProcessImage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image_file = os.path.join(self.tmp_dir, 'image.png')
+        make_image(self.image_file)
+        self.conf = json.load(open(conf_file))
+        self.conf.update({'n_generations': 200, 'seed': 1, 'lambda': 1,
+                          'islands': 1, 'checkpoint_every': 3,
+                          'pyramid_levels': 2, 'pyramid_generations': 80,
+                          'pyramid_plateau': 60, 'ref_cache': self.tmp_dir})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_image(self, name, crash_after=None):
+        """process the image, optionally crash after some mutations"""
+        outfolder = os.path.join(self.tmp_dir, name)
+        os.mkdir(outfolder)
+        mutate, count = pool.Drawing.mutate, [0]
+        def crashing_mutate(drawing):
+            count[0] += 1
+            if count[0] > crash_after:
+                raise KeyboardInterrupt
+            mutate(drawing)
+        if crash_after:
+            pool.Drawing.mutate = crashing_mutate
+            try:
+                main_batch.process_image(self.image_file, self.conf, outfolder)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                pool.Drawing.mutate = mutate
+            checkpoint = pickle.load(open(os.path.join(
+                outfolder, 'image', 'checkpoint.pckl'), 'rb'))
+            self.assertEqual(checkpoint['level'], 1)
+        result = main_batch.process_image(self.image_file, self.conf, outfolder)
+        return result, json.load(open(os.path.join(outfolder, 'image',
+                                                   'polies.json')))
+
+    def test_resume_coarse_level(self):
+        """a run continued on a coarse level keeps its pyramid schedule"""
+        result, polies = self.run_image('uninterrupted')
+        resumed_result, resumed_polies = self.run_image('resumed',
+                                                        crash_after=50)
+        self.assertEqual(polies, resumed_polies)
+        for key in ['error', 'generations', 'selections', 'stop_reason']:
+            self.assertEqual(result[key], resumed_result[key])
+
+    def test_drawing_pickle(self):
+        """the pickled drawing only needs the copy of the image next to it,
+            also in another folder
+        """
+        cache = os.path.join(self.tmp_dir, 'pickle_cache')
+        self.conf.update(n_generations=30, pyramid_levels=1, ref_cache=cache)
+        result, polies = self.run_image('pickle')
+        shutil.rmtree(cache)
+        os.remove(self.image_file)
+        moved = os.path.join(self.tmp_dir, 'moved')
+        shutil.move(os.path.join(self.tmp_dir, 'pickle', 'image'), moved)
+        drawing = refstore.load_pickle(os.path.join(moved, 'drawing.pckl'))
+        self.assertEqual(drawing.ref_image.shape, (60, 80, 3))
+        self.assertEqual(int(drawing.evaluate()), result['error'])
+
+    def test_broken_image(self):
+        """a broken image does not stop the other images in the workers"""
+        self.conf.update(n_generations=30, pyramid_levels=1)
+        broken_file = os.path.join(self.tmp_dir, 'broken.png')
+        open(broken_file, 'w').write('not a png')
+        other_file = os.path.join(self.tmp_dir, 'other.png')
+        shutil.copyfile(self.image_file, other_file)
+        outfolder = os.path.join(self.tmp_dir, 'workers')
+        os.mkdir(outfolder)
+        main_batch.process_images([self.image_file, broken_file, other_file],
+                                  self.conf, outfolder, 2)
+        results = json.load(open(os.path.join(outfolder, 'results.json')))
+        self.assertEqual(sorted(results), ['broken.png', 'image.png',
+                                           'other.png'])
+        self.assertTrue('Traceback' in results['broken.png']['failed'])
+        for name in ['image', 'other']:
+            self.assertEqual(results[name + '.png']['generations'], 30)
+            self.assertTrue(os.path.exists(os.path.join(outfolder, name,
+                                                        'polies.json')))
+
+
+if __name__ == '__main__':
+    unittest.main()
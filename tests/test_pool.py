@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_pool.py
+
+the optimized code paths of the genetic algorithm have to produce exactly
+the same results as the plain implementation, this is checked here by
+running the same random mutations through both versions.
+"""
+
+import os, sys
+import time
+import copy
+import json
+import pickle
+import shutil
+import tempfile
+import unittest
+import cairo
+import numpy as np
+from poly_burst.genetics import pool
+from poly_burst.genetics.genome import Genome
+from poly_burst.genetics import raster
+from poly_burst.genetics import parallel
+from poly_burst.genetics import profiling
+from poly_burst.genetics.telemetry import Series
+
+conf_file = os.path.join(os.path.dirname(__file__), '..', 'genetics', 'conf.json')
+
+
+def make_image(fname, width=80, height=60):
+    """paint some shapes with smooth color gradients into a png file"""
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+    context = cairo.Context(surface)
+    ar = pool.surface_array(surface)
+    yy, xx = np.mgrid[0:height, 0:width]
+    ar[:,:,0] = 255 * xx / width
+    ar[:,:,1] = 255 * yy / height
+    surface.mark_dirty()
+    pool.draw_poly(context, {'points': [(10, 10), (50, 5), (30, 40)],
+                             'color': (0.9, 0.2, 0.1, 1)})
+    pool.draw_poly(context, {'points': [(40, 30), (75, 35), (70, 58), (45, 50)],
+                             'color': (0.1, 0.8, 0.3, 1)})
+    surface.write_to_png(fname)
+
+
+class TestEvolution(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image_file = os.path.join(self.tmp_dir, 'image.png')
+        make_image(self.image_file)
+        self.conf = json.load(open(conf_file))
+        # high rates to get all kinds of mutations in a short run
+        self.conf.update({'mutation_rate': 0.3, 'poly_rate': 0.3,
+                          'move_poly_rate': 0.3, 'point_rate': 0.3,
+                          'move_point_rate': 0.3, 'color_std': 0.1,
+                          'render_cache': False, 'incremental_error': False,
+                          'seed': 1, 'ref_cache': self.tmp_dir})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def evolve(self, n_generations=200, bounded=False, **options):
+        """run the genetic loop and return all errors computed on the way"""
+        conf = dict(self.conf, **options)
+        drawing = pool.Drawing(self.image_file, conf)
+        error = sys.maxint
+        errors = []
+        for i in range(n_generations):
+            drawing.mutate()
+            tmp_error = drawing.evaluate(error if bounded else None)
+            errors.append(tmp_error)
+            if tmp_error <= error:
+                error = tmp_error
+            else:
+                drawing.revert_last_mutation()
+        return errors, drawing
+
+    def test_render_cache(self):
+        """the cached rendering gives the same errors as a full repaint"""
+        plain, _ = self.evolve()
+        cached, _ = self.evolve(render_cache=True)
+        self.assertEqual(plain, cached)
+
+    def test_incremental_error(self):
+        """error of the dirty rectangle gives the same as the full error"""
+        plain, _ = self.evolve()
+        incremental, _ = self.evolve(incremental_error=True)
+        self.assertEqual(plain, incremental)
+        both, _ = self.evolve(incremental_error=True, render_cache=True)
+        self.assertEqual(plain, both)
+
+    def test_early_abort(self):
+        """exactly the mutations worse than the current drawing are rejected"""
+        for incremental in [False, True]:
+            plain, drawing = self.evolve(incremental_error=incremental)
+            expected, error = [], sys.maxint
+            for tmp_error in plain:
+                expected.append(tmp_error if tmp_error <= error else pool.REJECTED)
+                error = min(error, tmp_error)
+            bounded, aborted = self.evolve(bounded=True, early_abort=True,
+                                           abort_rows=4,
+                                           incremental_error=incremental)
+            self.assertEqual(expected, bounded)
+            self.assertEqual(drawing.polies, aborted.polies)
+            self.assertEqual(list(drawing.errors.series()[1]),
+                             list(aborted.errors.series()[1]))
+
+    def test_scratch_buffers(self):
+        """the errors with the scratch buffers are the plain numpy errors,
+            also after set_level allocated new buffers
+        """
+        conf = dict(self.conf, pyramid_levels=2)
+        reference = pool.Drawing(self.image_file, conf)
+        for options in [{}, {'incremental_error': True, 'render_cache': True},
+                        {'early_abort': True, 'abort_rows': 4}]:
+            drawing = pool.Drawing(self.image_file, dict(conf, **options))
+            for level in [1, 0]:
+                if drawing.level != level:
+                    drawing.set_level(level)
+                if reference.level != level:
+                    reference.set_level(level)
+                self.assertEqual(drawing._diff.shape, (drawing.h, drawing.w, 3))
+                error = drawing.evaluate()
+                for i in range(30):
+                    drawing.mutate()
+                    tmp_error = drawing.evaluate(error)
+                    reference.set_polies(copy.deepcopy(drawing.polies))
+                    image = reference.as_array()
+                    expected = ((drawing.ref_image.astype(int) - image) ** 2).sum()
+                    self.assertEqual(pool.ssd(drawing.ref_image, image,
+                                              drawing._diff), expected)
+                    partial, complete = pool.bounded_ssd(
+                        drawing.ref_image, image, drawing._diff, error, 4)
+                    self.assertEqual(complete, expected <= error)
+                    if complete:
+                        self.assertEqual(partial, expected)
+                    else:
+                        self.assertTrue(error < partial <= expected)
+                    if tmp_error <= error:
+                        self.assertEqual(tmp_error, expected)
+                        error = tmp_error
+                    else:
+                        self.assertTrue(expected > error)
+                        drawing.revert_last_mutation()
+
+    def test_revert(self):
+        """reverting a mutation restores exactly the drawing before it"""
+        _, drawing = self.evolve(n_generations=10)
+        for i in range(100):
+            before = copy.deepcopy(drawing.polies)
+            drawing.mutate()
+            drawing.evaluate()
+            drawing.revert_last_mutation()
+            self.assertEqual(before, drawing.polies)
+        self.assertRaises(Exception, drawing.revert_last_mutation)
+
+    def test_seed(self):
+        """the seed alone determines the evolution"""
+        first, drawing = self.evolve(n_generations=50)
+        np.random.seed(123)
+        second, _ = self.evolve(n_generations=50)
+        self.assertEqual(first, second)
+        self.assertEqual(drawing.conf['image_seed'],
+                         pool.image_seed(1, self.image_file))
+        other, _ = self.evolve(n_generations=50, seed=2)
+        self.assertNotEqual(first, other)
+
+    def test_random_blocks(self):
+        """a checkpoint also restores the random numbers drawn in advance"""
+        _, drawing = self.evolve(n_generations=20, random_blocks=True)
+        checkpoint = pickle.loads(pickle.dumps(drawing.get_checkpoint()))
+        results = []
+        for i in range(2):
+            drawing.set_checkpoint(checkpoint)
+            for j in range(30):
+                drawing.mutate()
+            results.append(copy.deepcopy(drawing.polies))
+        self.assertEqual(results[0], results[1])
+        # a pickle continues with the numbers that were not used yet
+        blocks = pool.RandomBlocks(np.random.RandomState(5), size=100)
+        blocks.uniform(70)
+        blocks.normal(30)
+        copied = pickle.loads(pickle.dumps(blocks, 2))
+        self.assertEqual(copied.uniform(50), blocks.uniform(50))
+        self.assertEqual(copied.normal(90), blocks.normal(90))
+
+    def test_adaptive_rates(self):
+        """the rates only change with adaptive_rates and stay in bounds"""
+        _, drawing = self.evolve()
+        self.assertEqual(drawing.adapted_rates(),
+                         dict((key, self.conf[key])
+                              for key in drawing.adapted_rates()))
+        _, drawing = self.evolve(adaptive_rates=True, adapt_window=10)
+        rates = drawing.adapted_rates()
+        self.assertNotEqual(rates['move_point'], self.conf['move_point'])
+        for key in pool.ADAPTIVE_RATES:
+            self.assertTrue(pool.RATE_BOUNDS[0] <= rates[key] <= pool.RATE_BOUNDS[1])
+        self.assertFalse(self.conf['adaptive_rates'])
+
+    def test_color_refit(self):
+        """the mean colors of the visible pixels improve the drawing"""
+        _, drawing = self.evolve(n_generations=100)
+        error = drawing.evaluate()
+        before = copy.deepcopy(drawing.polies)
+        self.assertTrue(drawing.refit_colors())
+        self.assertTrue(drawing.evaluate() < error)
+        drawing.revert_last_mutation()
+        self.assertEqual(before, drawing.polies)
+        self.assertEqual(drawing.evaluate(), error)
+        _, drawing = self.evolve(n_generations=10, alpha_mutations=True)
+        self.assertFalse(drawing.refit_colors())
+
+    def test_init(self):
+        """the seeded polygons fit the image better than random ones"""
+        conf = dict(self.conf, min_polies=5)
+        error = pool.Drawing(self.image_file, conf).evaluate()
+        for init in ['kmeans', 'gradient']:
+            drawing = pool.Drawing(self.image_file, dict(conf, init=init))
+            self.assertEqual(len(drawing.polies), 5)
+            for poly in drawing.polies:
+                self.assertTrue(len(poly['points']) >= 3)
+                for x, y in poly['points']:
+                    self.assertTrue(0 <= x <= drawing.w and 0 <= y <= drawing.h)
+            self.assertTrue(drawing.evaluate() < error)
+        self.assertRaises(Exception, pool.Drawing, self.image_file,
+                          dict(conf, init='unknown'))
+
+    def test_error_heatmap(self):
+        """the heatmap is the error of the accepted drawing in tiles"""
+        _, drawing = self.evolve(random_blocks=True, incremental_error=True,
+                                 error_heatmap=True, heatmap_tile=16)
+        heat = drawing.get_checkpoint()['heatmap']
+        image = drawing.as_array()
+        squares = ((drawing.ref_image.astype(int) - image) ** 2).sum(axis=2)
+        self.assertEqual(heat.shape, (4, 5))
+        for ty in range(4):
+            for tx in range(5):
+                self.assertEqual(heat[ty, tx], squares[ty*16:(ty+1)*16,
+                                                       tx*16:(tx+1)*16].sum())
+        # the heatmap would never be updated or used
+        for options in [{'random_blocks': False}, {'incremental_error': False}]:
+            conf = dict(self.conf, error_heatmap=True, random_blocks=True,
+                        incremental_error=True)
+            conf.update(options)
+            self.assertRaises(Exception, pool.Drawing, self.image_file, conf)
+
+    def test_spatial_index(self):
+        """the index finds the same polygons as checking all of them"""
+        for random_blocks in [False, True]:
+            _, drawing = self.evolve(n_generations=10,
+                                     random_blocks=random_blocks)
+            index = drawing.spatial_index()
+            rng = np.random.RandomState(0)
+            for i in range(200):
+                drawing.mutate()
+                drawing.evaluate()
+                if i % 2:
+                    drawing.revert_last_mutation()
+                x0, y0 = rng.randint(0, drawing.w), rng.randint(0, drawing.h)
+                rect = (x0, y0, x0 + rng.randint(1, 30), y0 + rng.randint(1, 30))
+                expected = [id(poly) for poly in drawing.polies
+                            if pool.rects_overlap(rect, pool.poly_bbox(
+                                poly, drawing.w, drawing.h))]
+                self.assertEqual(len(index), len(drawing.polies))
+                self.assertEqual(sorted(expected),
+                                 sorted(id(poly) for poly in index.query(rect)))
+
+    def offspring_runs(self, conf, n_generations=300):
+        """(1+lambda) evolution with 1 and 2 workers, returns the selected
+            (error, polies) of both runs
+        """
+        image_file = os.path.join(self.tmp_dir, 'small.png')
+        make_image(image_file, 40, 30)
+        start = pool.Drawing(image_file, conf).polies
+        runs = []
+        for n_workers in [1, 2]:
+            offspring = parallel.OffspringPool(image_file, conf, n_workers)
+            rng = np.random.RandomState(3)
+            error, polies, selected = sys.maxint, start, []
+            for i in range(n_generations):
+                tmp_error, tmp_polies = offspring.best_offspring(polies, 0, rng)
+                if tmp_error <= error:
+                    error, polies = tmp_error, tmp_polies
+                selected.append((error, polies))
+            offspring.close()
+            runs.append(selected)
+        return runs
+
+    def test_offspring(self):
+        """the best offspring does not depend on the number of workers"""
+        conf = dict(self.conf, **{'lambda': 4})
+        first, second = self.offspring_runs(conf)
+        self.assertEqual(first, second)
+        # the error belongs to the returned polygons
+        drawing = pool.Drawing(os.path.join(self.tmp_dir, 'small.png'), conf)
+        drawing.set_polies(copy.deepcopy(first[-1][1]))
+        self.assertEqual(drawing.evaluate(), first[-1][0])
+        # only the serial evolution adapts its rates, not the workers
+        conf.update(adaptive_rates=True, adapt_window=2)
+        first, second = self.offspring_runs(conf)
+        self.assertEqual(first, second)
+        drawing.set_polies(copy.deepcopy(first[-1][1]))
+        self.assertEqual(drawing.evaluate(), first[-1][0])
+
+    def test_set_level(self):
+        """the polygons are rescaled (and clamped) between the levels"""
+        image_file = os.path.join(self.tmp_dir, 'odd.png')
+        make_image(image_file, 83, 61)
+        drawing = pool.Drawing(image_file, dict(self.conf, pyramid_levels=3))
+        self.assertEqual((drawing.level, drawing.w, drawing.h), (2, 20, 15))
+        self.assertEqual(drawing.ref_image.shape, (15, 20, 3))
+        color = (0.5, 0.2, 0.7, 1)
+        # up
+        drawing.set_polies([{'points': [(0, 0), (20, 15), (10, 3)],
+                             'color': color}])
+        drawing.set_level(1)
+        self.assertEqual((drawing.w, drawing.h), (41, 30))
+        self.assertEqual(drawing.polies[0]['points'], [(0, 0), (40, 30), (20, 6)])
+        drawing.set_level(0)
+        self.assertEqual((drawing.w, drawing.h), (83, 61))
+        self.assertEqual(drawing.polies[0]['points'], [(0, 0), (80, 60), (40, 12)])
+        # down, the points outside of the coarse image are clamped
+        drawing.set_polies([{'points': [(0, 0), (83, 61), (41, 13)],
+                             'color': color}])
+        drawing.set_level(2)
+        self.assertEqual(drawing.polies[0]['points'],
+                         [(0, 0), (20, 15), (10.25, 3.25)])
+        drawing.evaluate()
+        drawing.set_level(0)
+        self.assertEqual(drawing.polies[0]['points'], [(0, 0), (80, 60), (41, 13)])
+        native = pool.Drawing(image_file, self.conf)
+        native.set_polies(copy.deepcopy(drawing.polies))
+        self.assertEqual(drawing.evaluate(), native.evaluate())
+
+    def test_offspring_level(self):
+        """a level change of the parent does not rescale it a second time
+            in the drawing of the offspring
+        """
+        conf = dict(self.conf, pyramid_levels=2, **{'lambda': 3})
+        drawing = pool.Drawing(self.image_file, conf)
+        offspring = parallel.OffspringPool(self.image_file, conf, 1)
+        rng = np.random.RandomState(3)
+        offspring.best_offspring(drawing.polies, drawing.level, rng)
+        drawing.set_level(0)
+        points = [poly['points'] for poly in drawing.polies]
+        error, polies = offspring.best_offspring(drawing.polies, 0, rng)
+        self.assertEqual([poly['points'] for poly in drawing.polies], points)
+        offspring.close()
+
+    def test_islands(self):
+        """the worst islands are replaced by the best one and the islands
+            do not depend on the number of workers
+        """
+        conf = dict(self.conf, islands=3, migration_interval=30,
+                    island_migrants=1)
+        drawing = pool.Drawing(self.image_file, conf)
+        population = [drawing.polies] + [drawing.create_polies()
+                                         for i in range(2)]
+        runs = []
+        for n_workers in [1, 2]:
+            islands = parallel.IslandPool(self.image_file, conf, n_workers)
+            rng = np.random.RandomState(3)
+            results = islands.evolve(copy.deepcopy(population), rng=rng)
+            # the second migration interval starts from the migrated islands
+            results += islands.evolve([polies for e, polies in results],
+                                      rng=rng)
+            islands.close()
+            runs.append(results)
+        self.assertEqual(runs[0], runs[1])
+        for results in [runs[0][:3], runs[0][3:]]:
+            errors = [error for error, polies in results]
+            self.assertTrue(errors[0] <= errors[1])
+            self.assertEqual(results[2], results[0])
+
+    def test_genome(self):
+        """polygons survive the conversion to the compact genome"""
+        _, drawing = self.evolve(n_generations=50)
+        polies = drawing.get_sorted_polies()
+        genome = Genome.from_polies(polies, 20, 7)
+        self.assertEqual(polies, genome.to_polies())
+        genome.swap_polies(0, len(genome) - 1)
+        genome.remove_poly(1)
+        genome.insert_poly(0, polies[2])
+        copied = pickle.loads(pickle.dumps(genome.copy()))
+        self.assertEqual(genome.to_polies(), copied.to_polies())
+        reloaded = pickle.loads(pickle.dumps(drawing))
+        self.assertEqual(drawing.polies, reloaded.polies)
+
+    def test_raster(self):
+        """numpy rendering is close to cairo (see tolerance in raster.py)"""
+        _, drawing = self.evolve(n_generations=100)
+        error = drawing.evaluate()
+        cairo_image = pool.to_numpy(drawing.surface)
+        numpy_image = raster.render(drawing.polies, drawing.w, drawing.h)
+        diff = np.abs(cairo_image - numpy_image).max(axis=2)
+        # the pixels cut by a polygon edge, found by walking along the edges
+        edges = np.zeros((drawing.h, drawing.w), bool)
+        for poly in drawing.polies:
+            points = np.array(poly['points'] + poly['points'][:1], float)
+            for (x0, y0), (x1, y1) in zip(points[:-1], points[1:]):
+                t = np.linspace(0, 1, int(20 * max(abs(x1 - x0), abs(y1 - y0))) + 2)
+                xs = np.clip(np.floor(x0 + t * (x1 - x0)).astype(int), 0, drawing.w - 1)
+                ys = np.clip(np.floor(y0 + t * (y1 - y0)).astype(int), 0, drawing.h - 1)
+                edges[ys, xs] = True
+        self.assertTrue(edges.any() and not edges.all())
+        self.assertTrue(diff[~edges].max() <= 1)
+        self.assertTrue(diff.max() <= 255.0 / raster.SAMPLES + 1)
+        errors = drawing.evaluate_batch([drawing.polies, drawing.polies[:-1]])
+        self.assertEqual(errors.shape, (2,))
+        self.assertTrue(abs(errors[0] - error) < 0.01 * error)
+
+    def test_sorted_polies(self):
+        """ranking the polygons gives the errors of a full repaint"""
+        _, drawing = self.evolve(n_generations=300, alpha_mutations=True)
+        error = drawing.evaluate()
+        expected = []
+        for i in range(len(drawing.polies)):
+            drawing.context.set_source_rgb(1, 1, 1)
+            drawing.context.paint()
+            for poly in drawing.polies[:i] + drawing.polies[i+1:]:
+                pool.draw_poly(drawing.context, poly)
+            im_ar = pool.to_numpy(drawing.surface)
+            diff = drawing.ref_image.astype(int) - im_ar
+            expected.append(np.abs(error - np.sum(diff**2)))
+        drawing.get_sorted_polies()
+        self.assertEqual(expected, [poly['error'] for poly in drawing.polies])
+
+    def test_telemetry(self):
+        """the history stays bounded but keeps the count and last value"""
+        series = Series(capacity=16)
+        values = []
+        for i in range(1000):
+            series.append(i * 3)
+            values.append(i * 3)
+            if i % 3 == 1:
+                self.assertEqual(series.pop(), values.pop())
+            self.assertEqual(len(series), len(values))
+            self.assertEqual(series.last, values[-1])
+        index, stored = series.series()
+        self.assertTrue(len(stored) <= 17)
+        self.assertEqual(stored[-1], values[-1])
+        self.assertEqual(list(stored), [values[i] for i in index])
+        copied = pickle.loads(pickle.dumps(series))
+        self.assertEqual(list(copied.series()[1]), list(stored))
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_percentile(self):
+        """the percentile is the center of the bin in which it falls"""
+        edges = profiling.BIN_EDGES
+        histogram = np.zeros(len(edges) + 1, np.int64)
+        self.assertEqual(profiling.percentile(histogram, 50), 0.0)
+        # a time exactly on an edge belongs to the bin below it
+        profile = profiling.Profile()
+        for seconds in [edges[30]] * 2 + [edges[30] * 1.01] * 2:
+            profile.add('step', seconds)
+        histogram = profile.phases['step']['histogram']
+        self.assertEqual(list(np.nonzero(histogram)[0]), [30, 31])
+        center = np.sqrt(edges[29] * edges[30])
+        self.assertAlmostEqual(profiling.percentile(histogram, 50), center)
+        self.assertAlmostEqual(profiling.percentile(histogram, 51),
+                               np.sqrt(edges[30] * edges[31]))
+        # times outside of the edges are in the first and last bin
+        profile.add('outside', 0)
+        profile.add('outside', 1e6)
+        histogram = profile.phases['outside']['histogram']
+        self.assertEqual(histogram[0] + histogram[-1], 2)
+        self.assertEqual(profiling.percentile(histogram, 50), edges[0])
+        self.assertEqual(profiling.percentile(histogram, 99), edges[-1])
+
+    def test_export(self):
+        """the exported phases can be summed up over several profiles"""
+        profiles = []
+        for n in [3, 5]:
+            profile = profiling.Profile()
+            for i in range(n):
+                with profiling.phase(profile, 'mutate'):
+                    pass
+            profile.add('render', 0.01 * n)
+            profiles.append(json.loads(json.dumps(profile.to_dict())))
+        self.assertEqual(profiles[0]['mutate']['count'], 3)
+        self.assertAlmostEqual(profiles[1]['render']['mean'], 0.05)
+        total = profiling.summary(profiles)
+        self.assertEqual(total['mutate']['count'], 8)
+        self.assertEqual(sum(total['mutate']['histogram']), 8)
+        self.assertAlmostEqual(total['render']['total'], 0.08)
+        self.assertEqual(total['render']['max'], 0.05)
+        for q in profiling.PERCENTILES:
+            self.assertTrue(0 < total['render']['p%d' % q] <= 0.1)
+        # without a profile nothing is recorded
+        with profiling.phase(None, 'mutate'):
+            pass
+
+    def test_sampling(self):
+        """the sampling profiler finds the busy function"""
+        def busy():
+            start = time.clock()
+            while time.clock() - start < 0.2:
+                pass
+        sampler = profiling.SamplingProfiler(interval=0.005)
+        sampler.start()
+        try:
+            busy()
+        finally:
+            sampler.stop()
+        result = json.loads(json.dumps(sampler.to_dict(top=5)))
+        self.assertEqual(sorted(result), ['cumulative', 'interval', 'samples',
+                                          'self'])
+        self.assertTrue(result['samples'] > 0)
+        self.assertTrue(len(result['self']) <= 5)
+        self.assertTrue(any('(busy)' in entry['function']
+                            for entry in result['cumulative']))
+
+
+if __name__ == '__main__':
+    unittest.main()